@@ -0,0 +1,82 @@
+import threading
+from pathlib import Path
+from typing import Callable, Dict, Mapping, TypeVar
+
+from PIL import Image
+
+T = TypeVar("T")
+
+
+class AssetStore:
+    """Animation frames decoded once and shared by all renders.
+
+    The images are stored as RGBA, so they can be pasted without further
+    conversion. They are shared, callers must treat them as read-only and
+    copy them before drawing on them.
+    """
+
+    def __init__(self):
+        self._images: Dict[str, Image.Image] = {}
+        self._paths: Dict[str, Path] = {}
+        # Images composed from the loaded ones
+        self._derived: Dict[str, object] = {}
+        # Held while derived images are built and while the images are swapped
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._images)
+
+    def __getitem__(self, name: str) -> Image.Image:
+        return self._images[name]
+
+    @property
+    def loaded(self) -> bool:
+        return bool(self._images)
+
+    def load(self, paths: Mapping[str, Path], *, reload: bool = False) -> None:
+        """Decode the images.
+
+        :param paths: Mapping of asset name to image file.
+        :param reload: Decode the images again even if they are loaded.
+        """
+        if self.loaded and not reload and dict(paths) == self._paths:
+            return
+        images: Dict[str, Image.Image] = {}
+        for name, path in paths.items():
+            with Image.open(path) as image:
+                images[name] = image.convert("RGBA")
+        # Swap at once, renders running meanwhile keep the old images
+        with self._lock:
+            self._images = images
+            self._paths = dict(paths)
+            self._derived = {}
+
+    def derived(self, name: str, build: Callable[[], T]) -> T:
+        """Get images made from the assets, building them on first use.
+
+        They are dropped when the assets are reloaded, and are just as
+        read-only as the assets themselves.
+        """
+        derived: Dict[str, object] = self._derived
+        if name in derived:
+            return derived[name]
+        # The images cannot be swapped during the build, so it never mixes
+        # old and new ones or stores old ones after a reload; two workers
+        # do not build the same images either
+        with self._lock:
+            if name not in self._derived:
+                self._derived[name] = build()
+            return self._derived[name]
+
+    @property
+    def memory(self) -> int:
+        """Size of the decoded and derived images in bytes."""
+        images = list(self._images.values())
+        for value in self._derived.values():
+            images += value if isinstance(value, (list, tuple)) else [value]
+        return sum(
+            image.width * image.height * len(image.getbands()) for image in images
+        )
+
+
+assets = AssetStore()
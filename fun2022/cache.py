@@ -0,0 +1,48 @@
+import collections
+from typing import Callable, Generic, Hashable, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+class SizedLRU(Generic[T]):
+    """Least recently used cache bounded by the total size of its items.
+
+    :param max_size: Maximal total size of the items in bytes.
+    :param sizeof: Function returning the size of an item in bytes.
+    """
+
+    def __init__(self, max_size: int, sizeof: Callable[[T], int]):
+        self.max_size: int = max_size
+        self.sizeof: Callable[[T], int] = sizeof
+        self.size: int = 0
+        self.hits: int = 0
+        self.misses: int = 0
+        self._items: collections.OrderedDict[Hashable, T] = collections.OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def get(self, key: Hashable) -> Optional[T]:
+        item: Optional[T] = self._items.get(key, None)
+        if item is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._items.move_to_end(key)
+        return item
+
+    def put(self, key: Hashable, item: T) -> None:
+        size: int = self.sizeof(item)
+        if size > self.max_size:
+            return
+        if key in self._items:
+            self.size -= self.sizeof(self._items.pop(key))
+        self._items[key] = item
+        self.size += size
+        while self.size > self.max_size:
+            _, evicted = self._items.popitem(last=False)
+            self.size -= self.sizeof(evicted)
+
+    def clear(self) -> None:
+        self._items.clear()
+        self.size = 0
@@ -0,0 +1,270 @@
+"""Checks of the fun2022 module that run without Discord.
+
+Run them from the root of the bot::
+
+    python -m modules.events.fun2022.checks --help
+    python -m modules.events.fun2022.checks frames
+
+Each check prints what it measured and fails with an assertion error
+when the module does not behave as expected.
+"""
+
+import argparse
+import asyncio
+import time
+import tracemalloc
+from io import BytesIO
+from typing import Callable, Dict, List, Optional, Tuple
+
+from aiohttp import web
+from PIL import Image
+
+from .assets import assets
+from .download import AvatarClient
+from .module import ASSETS, Fun2022, ImageUtils
+
+
+def _avatar() -> Image.Image:
+    avatar = Image.new("RGBA", (256, 256), (200, 40, 40, 255))
+    avatar.paste((40, 40, 200, 255), (64, 64, 192, 192))
+    return avatar
+
+
+def _composed_lick_frames(avatar: Image.Image) -> List[Image.Image]:
+    """Lick frames composed from scratch, as before the backgrounds were kept"""
+    frames = []
+    width, height = 605, 480
+    voffset = (1, 0, 0, 1)
+    hoffset = (0, 1, 1, 0)
+
+    pepe = assets["pepe_lick"]
+    avatar = ImageUtils.round_image(avatar.resize((130, 140)))
+
+    for i in range(4):
+        img = ("01", "02", "03", "02")[i]
+        peepo = assets[f"lick/{img}"]
+
+        frame = Image.new("RGBA", (width, height), (54, 57, 63, 1))
+        frame.paste(peepo, (0, 140), peepo)
+        frame.paste(pepe, (50 + hoffset[i], 0), pepe)
+        frame.paste(avatar, (425 + hoffset[i], voffset[i]), avatar)
+        frames.append(frame)
+
+    return frames
+
+
+def _composed_hyperlick_frames(avatar: Image.Image) -> List[Image.Image]:
+    """Hyperlick frames composed from scratch"""
+    frames = []
+    width, height = 605, 400
+    voffset = (1, 0, 0, 1)
+    hoffset = (0, 1, 1, 0)
+
+    pepe = assets["pepe_hyperlick"]
+    avatar = ImageUtils.round_image(avatar.resize((128, 140)))
+
+    for i in range(4):
+        img = ("01", "02", "03", "02")[i]
+        peepo = assets[f"lick/{img}"]
+
+        frame = Image.new("RGBA", (width, height), (54, 57, 63, 1))
+        frame.paste(peepo, (0, 40), peepo)
+        frame.paste(pepe, (80 + hoffset[i], 0), pepe)
+        frame.paste(avatar, (438 + hoffset[i], voffset[i]), avatar)
+        frames.append(frame)
+
+    return frames
+
+
+def _composed_slap_frames(avatar: Image.Image) -> List[Image.Image]:
+    """Slap frames composed from scratch"""
+    frames = []
+    width, height = 190, 260
+    hoffset = (20, 17, 18, 21, 18, 24, 33, 38)
+    voffset = (45, 46, 45, 43, 32, 18, 7, 3)
+
+    avatar = ImageUtils.round_image(avatar.resize((45, 45)))
+
+    for i in range(8):
+        frame_object = assets[f"slap/{i + 1:02}"]
+
+        frame = Image.new("RGBA", (width, height), (54, 57, 63, 1))
+        frame.paste(frame_object, (0, 0), frame_object)
+        frame.paste(avatar, (voffset[i], hoffset[i]), avatar)
+        frames.append(frame)
+
+    return frames
+
+
+def _measure(
+    get_frames: Callable[[Image.Image], List[Image.Image]],
+    avatar: Image.Image,
+    repeat: int,
+) -> Tuple[float, float, float]:
+    """Build the frames repeatedly.
+
+    Pixel buffers are allocated by Pillow outside of the Python allocator,
+    so they are counted by Pillow's own statistics; tracemalloc only sees
+    the Python objects.
+
+    :return: CPU milliseconds, new Pillow images and peak of traced Python
+        memory in kB, all per command.
+    """
+    Image.core.reset_stats()
+    tracemalloc.start()
+    start: float = time.process_time()
+    for _ in range(repeat):
+        get_frames(avatar)
+    cpu: float = time.process_time() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    images: int = Image.core.get_stats()["new_count"]
+    return cpu * 1000 / repeat, images / repeat, peak / 1024
+
+
+def check_frames(args: argparse.Namespace):
+    """Compare building the frames on kept backgrounds with composing them."""
+    assets.load(ASSETS)
+    avatar = _avatar()
+
+    for effect, composed, cached in (
+        ("lick", _composed_lick_frames, Fun2022.get_lick_frames),
+        ("hyperlick", _composed_hyperlick_frames, Fun2022.get_hyperlick_frames),
+        ("slap", _composed_slap_frames, Fun2022.get_slap_frames),
+    ):
+        # Backgrounds are built by the first command, not measured here
+        cached(avatar)
+
+        old = list(composed(avatar))
+        new = list(cached(avatar))
+        assert len(old) == len(new), effect
+        for old_frame, new_frame in zip(old, new):
+            assert old_frame.tobytes() == new_frame.tobytes(), effect
+
+        old_cpu, old_images, old_peak = _measure(composed, avatar, args.repeat)
+        new_cpu, new_images, new_peak = _measure(cached, avatar, args.repeat)
+        print(
+            f"  {effect}: composed {old_cpu:.2f} ms, {old_images:.0f} images, "
+            f"{old_peak:.0f} kB peak; "
+            f"cached {new_cpu:.2f} ms, {new_images:.0f} images, "
+            f"{new_peak:.0f} kB peak"
+        )
+        assert new_cpu < old_cpu, effect
+
+
+def check_download(args: argparse.Namespace):
+    """Download and decode avatars from a local stand-in of the CDN."""
+    peers = set()
+    avatar: bytes = b"x" * 1000
+
+    async def ok(request: web.Request) -> web.Response:
+        peers.add(request.transport.get_extra_info("peername"))
+        return web.Response(body=avatar)
+
+    async def missing(request: web.Request) -> web.Response:
+        return web.Response(status=404)
+
+    async def large(request: web.Request) -> web.Response:
+        return web.Response(body=b"x" * 5000)
+
+    async def stream(request: web.Request) -> web.StreamResponse:
+        # Without Content-Length the size is only known while reading
+        response = web.StreamResponse()
+        await response.prepare(request)
+        for _ in range(10):
+            await response.write(b"x" * 1000)
+        return response
+
+    async def slow(request: web.Request) -> web.Response:
+        await asyncio.sleep(3)
+        return web.Response(body=avatar)
+
+    async def run():
+        app = web.Application()
+        app.add_routes(
+            [
+                web.get("/ok", ok),
+                web.get("/missing", missing),
+                web.get("/large", large),
+                web.get("/stream", stream),
+                web.get("/slow", slow),
+            ]
+        )
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        host, port = runner.addresses[0][:2]
+        url: str = f"http://{host}:{port}"
+
+        client = AvatarClient(max_size=2000, timeout=1.0)
+        try:
+            for _ in range(args.downloads):
+                assert await client.get(url + "/ok") == avatar
+            print(f"  {args.downloads} downloads used {len(peers)} connections")
+            assert len(peers) == 1, peers
+
+            for path in ("/missing", "/large", "/stream", "/slow"):
+                start: float = time.monotonic()
+                assert await client.get(url + path) is None, path
+                print(f"  {path}: refused in {time.monotonic() - start:.2f} s")
+            # Nothing listens on the port
+            assert await client.get("http://127.0.0.1:1/") is None
+        finally:
+            await client.close()
+            await runner.cleanup()
+
+    asyncio.run(run())
+
+    with BytesIO() as stream:
+        _avatar().save(stream, format="PNG")
+        png: bytes = stream.getvalue()
+    assert Fun2022._decode_avatar(png) is not None
+    for name, data in (
+        ("empty", b""),
+        ("junk", b"junk"),
+        ("truncated", png[: len(png) // 2]),
+    ):
+        assert Fun2022._decode_avatar(data) is None, name
+        print(f"  {name} avatar: refused")
+
+    limit: Optional[int] = Image.MAX_IMAGE_PIXELS
+    Image.MAX_IMAGE_PIXELS = 256 * 256 // 4
+    try:
+        assert Fun2022._decode_avatar(png) is None
+        print("  decompression bomb: refused")
+    finally:
+        Image.MAX_IMAGE_PIXELS = limit
+
+
+CHECKS: Dict[str, Callable[[argparse.Namespace], None]] = {
+    "frames": check_frames,
+    "download": check_download,
+}
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(
+        prog="python -m modules.events.fun2022.checks",
+        description="Check the fun2022 module without connecting to Discord.",
+    )
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--downloads", type=int, default=20)
+    parser.add_argument(
+        "checks",
+        nargs="*",
+        metavar="CHECK",
+        help=f"checks to run: {', '.join(CHECKS)} (default: all)",
+    )
+    args = parser.parse_args(argv)
+    for name in args.checks:
+        if name not in CHECKS:
+            parser.error(f"unknown check: {name}")
+    for name in args.checks or CHECKS:
+        print(f"{name}: {CHECKS[name].__doc__}")
+        CHECKS[name](args)
+        print(f"{name}: ok")
+
+
+if __name__ == "__main__":
+    main()
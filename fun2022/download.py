@@ -0,0 +1,66 @@
+import asyncio
+from typing import Optional
+
+import aiohttp
+
+
+class AvatarClient:
+    """HTTP client for avatar downloads, shared for the cog's lifetime.
+
+    Connections to the CDN are pooled and kept alive between commands.
+    Every request has a timeout and the body size is capped, so a slow or
+    broken response cannot hold the command forever or fill the memory.
+
+    :param max_size: Maximal size of the response body in bytes.
+    :param timeout: Maximal duration of a request in seconds.
+    :param connections: Maximal number of open connections.
+    """
+
+    def __init__(
+        self,
+        *,
+        max_size: int = 4 * 1024 * 1024,
+        timeout: float = 10.0,
+        connections: int = 16,
+    ):
+        self.max_size: int = max_size
+        self.timeout: float = timeout
+        self.connections: int = connections
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        # The session has to be created inside the running event loop
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=self.connections, ttl_dns_cache=300
+                ),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+        return self._session
+
+    async def get(self, url: str) -> Optional[bytes]:
+        """Download the file.
+
+        :return: The body, or ``None`` if the request failed, did not
+            return 200 or the body was too large.
+        """
+        try:
+            async with self._get_session().get(url) as response:
+                if response.status != 200:
+                    return None
+                if (response.content_length or 0) > self.max_size:
+                    return None
+                data = bytearray()
+                async for chunk in response.content.iter_chunked(64 * 1024):
+                    data += chunk
+                    if len(data) > self.max_size:
+                        return None
+                return bytes(data)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            return None
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
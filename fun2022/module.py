@@ -1,13 +1,13 @@
-import aiohttp
+import functools
 from io import BytesIO
 from pathlib import Path
 from PIL import Image
-from typing import List, Union
+from typing import List, Optional, Union
 
 import nextcord
 from nextcord.ext import commands
 
-from pie import check, exceptions, i18n
+from pie import check, exceptions, i18n, utils
 
 try:
     from modules.fun.fun.module import Fun as SourceFun
@@ -16,13 +16,143 @@ try:
 except Exception:
     raise exceptions.ModuleException("events", "fun", "Missing dependence fun.fun.")
 
+from .assets import assets
+from .cache import SizedLRU
+from .download import AvatarClient
+from .render import RawImage, RenderExecutor, RenderQueueFull
+
 _ = i18n.Translator("modules/events").translate
 
 DATA_DIR = Path(__file__).parents[2] / "fun/fun/data"
 DATA_DIR2 = Path(__file__).parent / "data/"
 
+ASSETS = {
+    "pepe_lick": DATA_DIR2 / "pepe_lick.png",
+    "pepe_hyperlick": DATA_DIR2 / "pepe_hyperlick.png",
+    **{f"lick/{i:02}": DATA_DIR / f"lick/{i:02}.png" for i in range(1, 4)},
+    **{f"slap/{i:02}": DATA_DIR2 / f"slap/{i:02}.png" for i in range(1, 9)},
+}
+
 
 class Fun2022(SourceFun):
+    def __init__(self, bot):
+        super().__init__(bot)
+        # Frames are decoded once, not on every command
+        assets.load(ASSETS)
+        self.avatars = AvatarClient()
+        # Avatar hash -> decoded avatar
+        self.avatar_cache: SizedLRU[RawImage] = SizedLRU(
+            16 * 1024 * 1024, lambda avatar: len(avatar.data)
+        )
+        # (avatar hash, effect) -> GIF
+        self.gif_cache: SizedLRU[bytes] = SizedLRU(32 * 1024 * 1024, len)
+        self.renderer = RenderExecutor()
+
+    def cog_unload(self):
+        super().cog_unload()
+        self.bot.loop.create_task(self.avatars.close())
+        self.renderer.close()
+
+    @check.acl2(check.ACLevel.BOT_OWNER)
+    @commands.group(name="fun2022")
+    async def fun2022_(self, ctx):
+        """Manage the April Fools Day animations."""
+        await utils.discord.send_help(ctx)
+
+    @check.acl2(check.ACLevel.BOT_OWNER)
+    @fun2022_.command(name="assets")
+    async def fun2022_assets(self, ctx):
+        """Show memory used by the animation frames."""
+        await ctx.reply(
+            _(ctx, "{count} animation frames are loaded, using {size} kB.").format(
+                count=len(assets), size=assets.memory // 1024
+            )
+        )
+
+    @check.acl2(check.ACLevel.BOT_OWNER)
+    @fun2022_.command(name="reload")
+    async def fun2022_reload(self, ctx):
+        """Load the animation frames from disk again."""
+        await self.bot.loop.run_in_executor(
+            None, functools.partial(assets.load, ASSETS, reload=True)
+        )
+        # Cached GIFs were made from the old frames
+        self.gif_cache.clear()
+        await ctx.reply(_(ctx, "Animation frames have been reloaded."))
+
+    @check.acl2(check.ACLevel.BOT_OWNER)
+    @fun2022_.command(name="cache")
+    async def fun2022_cache(self, ctx):
+        """Show statistics of the avatar and GIF caches."""
+        lines: List[str] = []
+        for name, cache in (
+            (_(ctx, "Avatars"), self.avatar_cache),
+            (_(ctx, "GIFs"), self.gif_cache),
+        ):
+            lines.append(
+                _(
+                    ctx,
+                    "{name}: {count} items, {size} kB, {hits} hits, {misses} misses",
+                ).format(
+                    name=name,
+                    count=len(cache),
+                    size=cache.size // 1024,
+                    hits=cache.hits,
+                    misses=cache.misses,
+                )
+            )
+        await ctx.reply("\n".join(lines))
+
+    @commands.guild_only()
+    @commands.cooldown(rate=3, per=30.0, type=commands.BucketType.user)
+    @check.acl2(check.ACLevel.MEMBER)
+    @commands.command()
+    async def lick(self, ctx, *, user: Union[nextcord.Member, nextcord.Role] = None):
+        """Lick someone"""
+        if not await self._is_user_in_channel(ctx, user):
+            await ctx.reply(_(ctx, "You can't do that, they are not in this channel."))
+            return
+
+        if user is None:
+            source = self.bot.user
+            target = ctx.author
+        else:
+            source = ctx.author
+            target = user
+
+        if type(target) == nextcord.Role:
+            Relation.add(ctx.guild.id, source.id, None, "lick")
+        else:
+            Relation.add(ctx.guild.id, source.id, target.id, "lick")
+
+        await self._send_effect(ctx, target, "lick", duration=30)
+
+    @commands.guild_only()
+    @commands.cooldown(rate=3, per=30.0, type=commands.BucketType.user)
+    @check.acl2(check.ACLevel.MEMBER)
+    @commands.command()
+    async def hyperlick(
+        self, ctx, *, user: Union[nextcord.Member, nextcord.Role] = None
+    ):
+        """Hyperlick someone"""
+        if not await self._is_user_in_channel(ctx, user):
+            await ctx.reply(_(ctx, "You can't do that, they are not in this channel."))
+            return
+
+        if user is None:
+            source = self.bot.user
+            target = ctx.author
+        else:
+            source = ctx.author
+            target = user
+
+        if type(target) == nextcord.Role:
+            Relation.add(ctx.guild.id, source.id, None, "hyperlick")
+        else:
+            Relation.add(ctx.guild.id, source.id, target.id, "hyperlick")
+
+        await self._send_effect(ctx, target, "hyperlick", duration=30)
+
     @commands.guild_only()
     @commands.cooldown(rate=3, per=30.0, type=commands.BucketType.user)
     @check.acl2(check.ACLevel.MEMBER)
@@ -45,52 +175,138 @@ class Fun2022(SourceFun):
         else:
             Relation.add(ctx.guild.id, source.id, target.id, "slap")
 
+        await self._send_effect(ctx, target, "slap", duration=70)
+
+    async def _send_effect(
+        self,
+        ctx,
+        target: Union[nextcord.Member, nextcord.Role],
+        effect: str,
+        *,
+        duration: int,
+    ):
+        """Reply with the effect applied to the target's avatar.
+
+        :param effect: ``slap``, ``lick`` or ``hyperlick``.
+        :param duration: Duration of one frame in milliseconds.
+        """
         async with ctx.typing():
-            url = target.display_avatar.replace(size=256).url
-            async with aiohttp.ClientSession() as session:
-                response: aiohttp.ClientResponse = await session.get(url)
-                content: BytesIO = BytesIO(await response.read())
-                avatar: Image = Image.open(content).convert("RGBA")
-
-                frames = self.get_slap_frames(avatar)
-
-                with BytesIO() as image_binary:
-                    frames[0].save(
-                        image_binary,
-                        format="GIF",
-                        save_all=True,
-                        append_images=frames[1:],
-                        duration=70,
-                        loop=0,
-                        transparency=0,
-                        disposal=2,
-                        optimize=False,
+            # The avatar hash changes whenever the avatar does
+            key: str = target.display_avatar.key
+            image: Optional[bytes] = self.gif_cache.get((key, effect))
+            if image is None:
+                try:
+                    avatar = await self._get_avatar(target.display_avatar)
+                    if avatar is None:
+                        await ctx.reply(_(ctx, "The avatar could not be downloaded."))
+                        return
+                    image = await self.renderer.run(
+                        self.render_gif, effect, avatar, duration=duration
                     )
-                    image_binary.seek(0)
+                except RenderQueueFull:
                     await ctx.reply(
-                        file=nextcord.File(fp=image_binary, filename="slap.gif"),
-                        mention_author=False,
+                        _(ctx, "Too many images are being drawn, try again later.")
                     )
+                    return
+                self.gif_cache.put((key, effect), image)
+
+            with BytesIO(image) as image_binary:
+                await ctx.reply(
+                    file=nextcord.File(fp=image_binary, filename=f"{effect}.gif"),
+                    mention_author=False,
+                )
+
+    async def _get_avatar(self, asset: nextcord.Asset) -> Optional[RawImage]:
+        """Get decoded avatar, downloading it if it is not cached.
+
+        :raises RenderQueueFull: The avatar cannot be decoded now.
+        """
+        avatar: Optional[RawImage] = self.avatar_cache.get(asset.key)
+        if avatar is not None:
+            return avatar
+        data: Optional[bytes] = await self.avatars.get(asset.replace(size=256).url)
+        if data is None:
+            return None
+        avatar = await self.renderer.run(self._decode_avatar, data)
+        if avatar is not None:
+            self.avatar_cache.put(asset.key, avatar)
+        return avatar
+
+    @staticmethod
+    def _decode_avatar(data: bytes) -> Optional[RawImage]:
+        try:
+            with Image.open(BytesIO(data)) as image:
+                return RawImage.from_image(image)
+        # Unknown and truncated files raise OSError
+        except (OSError, Image.DecompressionBombError):
+            return None
+
+    @staticmethod
+    def render_gif(effect: str, avatar: RawImage, *, duration: int) -> bytes:
+        """Render the effect into a GIF.
+
+        This runs in a render worker; it only uses the shared assets for
+        reading.
+
+        :param effect: ``slap``, ``lick`` or ``hyperlick``.
+        :param duration: Duration of one frame in milliseconds.
+        """
+        get_frames = {
+            "slap": Fun2022.get_slap_frames,
+            "lick": Fun2022.get_lick_frames,
+            "hyperlick": Fun2022.get_hyperlick_frames,
+        }[effect]
+        return Fun2022._encode_gif(get_frames(avatar.to_image()), duration=duration)
+
+    @staticmethod
+    def _encode_gif(frames: List[Image.Image], *, duration: int) -> bytes:
+        with BytesIO() as image_binary:
+            frames[0].save(
+                image_binary,
+                format="GIF",
+                save_all=True,
+                append_images=frames[1:],
+                duration=duration,
+                loop=0,
+                transparency=0,
+                disposal=2,
+                optimize=False,
+            )
+            return image_binary.getvalue()
 
     @staticmethod
     def get_lick_frames(avatar: Image.Image) -> List[Image.Image]:
         """Get frames for the lick"""
         frames = []
-        width, height = 605, 480
         voffset = (1, 0, 0, 1)
         hoffset = (0, 1, 1, 0)
 
-        pepe = Image.open(DATA_DIR2 / "pepe_lick.png")
+        backgrounds = assets.derived("lick", Fun2022._get_lick_backgrounds)
         avatar = ImageUtils.round_image(avatar.resize((130, 140)))
 
+        for i in range(4):
+            frame = backgrounds[i].copy()
+            frame.paste(avatar, (425 + hoffset[i], voffset[i]), avatar)
+            frames.append(frame)
+
+        return frames
+
+    @staticmethod
+    def _get_lick_backgrounds() -> List[Image.Image]:
+        """Get lick frames without the avatar"""
+        frames = []
+        width, height = 605, 480
+        hoffset = (0, 1, 1, 0)
+
+        pepe = assets["pepe_lick"]
+
         for i in range(4):
             img = ("01", "02", "03", "02")[i]
-            peepo = Image.open(DATA_DIR / f"lick/{img}.png")
+            peepo = assets[f"lick/{img}"]
 
             frame = Image.new("RGBA", (width, height), (54, 57, 63, 1))
             frame.paste(peepo, (0, 140), peepo)
             frame.paste(pepe, (50 + hoffset[i], 0), pepe)
-            frame.paste(avatar, (425 + hoffset[i], voffset[i]), avatar)
             frames.append(frame)
 
         return frames
@@ -99,21 +315,35 @@ class Fun2022(SourceFun):
     def get_hyperlick_frames(avatar: Image.Image) -> List[Image.Image]:
         """Get frames for the hyperlick"""
         frames = []
-        width, height = 605, 400
         voffset = (1, 0, 0, 1)
         hoffset = (0, 1, 1, 0)
 
-        pepe = Image.open(DATA_DIR2 / "pepe_hyperlick.png")
+        backgrounds = assets.derived("hyperlick", Fun2022._get_hyperlick_backgrounds)
         avatar = ImageUtils.round_image(avatar.resize((128, 140)))
 
+        for i in range(4):
+            frame = backgrounds[i].copy()
+            frame.paste(avatar, (438 + hoffset[i], voffset[i]), avatar)
+            frames.append(frame)
+
+        return frames
+
+    @staticmethod
+    def _get_hyperlick_backgrounds() -> List[Image.Image]:
+        """Get hyperlick frames without the avatar"""
+        frames = []
+        width, height = 605, 400
+        hoffset = (0, 1, 1, 0)
+
+        pepe = assets["pepe_hyperlick"]
+
         for i in range(4):
             img = ("01", "02", "03", "02")[i]
-            peepo = Image.open(DATA_DIR / f"lick/{img}.png")
+            peepo = assets[f"lick/{img}"]
 
             frame = Image.new("RGBA", (width, height), (54, 57, 63, 1))
             frame.paste(peepo, (0, 40), peepo)
             frame.paste(pepe, (80 + hoffset[i], 0), pepe)
-            frame.paste(avatar, (438 + hoffset[i], voffset[i]), avatar)
             frames.append(frame)
 
         return frames
@@ -122,18 +352,30 @@ class Fun2022(SourceFun):
     def get_slap_frames(avatar: Image.Image) -> List[Image.Image]:
         """Get frames for the slap"""
         frames = []
-        width, height = 190, 260
         hoffset = (20, 17, 18, 21, 18, 24, 33, 38)
         voffset = (45, 46, 45, 43, 32, 18, 7, 3)
 
+        backgrounds = assets.derived("slap", Fun2022._get_slap_backgrounds)
         avatar = ImageUtils.round_image(avatar.resize((45, 45)))
 
         for i in range(8):
-            frame_object = Image.open(DATA_DIR2 / f"slap/0{i+1}.png")
+            frame = backgrounds[i].copy()
+            frame.paste(avatar, (voffset[i], hoffset[i]), avatar)
+            frames.append(frame)
+
+        return frames
+
+    @staticmethod
+    def _get_slap_backgrounds() -> List[Image.Image]:
+        """Get slap frames without the avatar"""
+        frames = []
+        width, height = 190, 260
+
+        for i in range(8):
+            frame_object = assets[f"slap/{i + 1:02}"]
 
             frame = Image.new("RGBA", (width, height), (54, 57, 63, 1))
             frame.paste(frame_object, (0, 0), frame_object)
-            frame.paste(avatar, (voffset[i], hoffset[i]), avatar)
             frames.append(frame)
 
         return frames
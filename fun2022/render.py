@@ -0,0 +1,76 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, NamedTuple, Optional, Tuple, TypeVar
+
+from PIL import Image
+
+T = TypeVar("T")
+
+
+class RenderQueueFull(Exception):
+    """Too many renders are running or waiting."""
+
+
+class RawImage(NamedTuple):
+    """RGBA pixels of an image, passed between the event loop and workers."""
+
+    data: bytes
+    size: Tuple[int, int]
+
+    @classmethod
+    def from_image(cls, image: Image.Image) -> "RawImage":
+        return cls(image.convert("RGBA").tobytes(), image.size)
+
+    def to_image(self) -> Image.Image:
+        """Get read-only image sharing the buffer."""
+        return Image.frombuffer("RGBA", self.size, self.data, "raw", "RGBA", 0, 1)
+
+
+class RenderExecutor:
+    """Run image renders in worker threads.
+
+    PIL releases the GIL while resizing, compositing and encoding, so worker
+    threads keep the event loop free, and they read the decoded assets
+    without copying them into other processes. At most ``queue_size``
+    renders are running or waiting at a time, further ones are refused.
+
+    :param workers: Number of worker threads.
+    :param queue_size: Maximal number of renders running or waiting.
+    :raises RenderQueueFull: From :meth:`run`, when the queue is full.
+    """
+
+    def __init__(self, *, workers: int = 2, queue_size: int = 8):
+        self.workers: int = workers
+        self.queue_size: int = queue_size
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._pending: int = 0
+
+    @property
+    def full(self) -> bool:
+        return self._pending >= self.queue_size
+
+    async def run(self, func: Callable[..., T], *args, **kwargs) -> T:
+        """Run the render in a worker.
+
+        Images should be passed in and out as buffers (:class:`RawImage`,
+        encoded bytes), so no image object is used by two threads.
+        """
+        if self.full:
+            raise RenderQueueFull()
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix="fun2022"
+            )
+        self._pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                self._executor, functools.partial(func, *args, **kwargs)
+            )
+        finally:
+            self._pending -= 1
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
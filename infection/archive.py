@@ -0,0 +1,203 @@
+import csv
+import datetime
+import gzip
+import io
+import json
+import math
+from typing import IO, Dict, Iterator, List, Optional, Tuple
+
+import nextcord
+
+from .cache import GuildConfig
+from .database import InfectionConfig, Infected
+
+# Columns of exported infections, the guild is given by the command
+FIELDS: Tuple[str, ...] = (
+    "user_id",
+    "channel_id",
+    "message_id",
+    "infected_by",
+    "infected_at",
+    "symptomatic",
+    "cured",
+)
+# Configuration that can be copied to another event
+CONFIG_FIELDS: Tuple[str, ...] = (
+    "probability",
+    "symptom_delay",
+    "cure_delay",
+    "quiet",
+    "enabled",
+)
+FORMATS: Tuple[str, ...] = ("jsonl", "csv")
+# Raised when an imported file is malformed
+ERRORS: Tuple[type, ...] = (
+    ValueError,
+    KeyError,
+    TypeError,
+    OSError,
+    EOFError,
+    csv.Error,
+)
+
+
+def export_config(config: InfectionConfig) -> bytes:
+    data: Dict = {key: getattr(config, key) for key in CONFIG_FIELDS}
+    data["symptom_delay"] = config.symptom_delay.total_seconds()
+    data["cure_delay"] = config.cure_delay.total_seconds()
+    return json.dumps(data, indent=4).encode("utf-8")
+
+
+def read_config(data: bytes, config: GuildConfig) -> Dict:
+    """Read the settings to copy into the configuration of a guild.
+
+    The role is kept, it belongs to the guild the configuration was made for.
+    The whole file is read and checked, so a malformed one changes nothing.
+
+    :param config: Current configuration, delays missing in the file are
+        taken from it.
+    :return: Values for :meth:`InfectionConfig.set`.
+    :raises ValueError: The file is not a configuration or a value is out
+        of its range.
+    """
+    values = json.loads(data)
+    if not isinstance(values, dict):
+        raise ValueError("The file does not contain a configuration.")
+
+    changes: Dict = {}
+    for key in CONFIG_FIELDS:
+        if key not in values:
+            continue
+        value = values[key]
+        if key in ("quiet", "enabled"):
+            if not isinstance(value, bool):
+                raise ValueError(f"{key} has to be true or false.")
+        elif key == "probability":
+            value = _number(key, value)
+            if value > 1.0:
+                raise ValueError("probability has to be in interval <0, 1>.")
+        else:
+            try:
+                value = datetime.timedelta(seconds=_number(key, value))
+            except OverflowError:
+                raise ValueError(f"{key} is too long.")
+        changes[key] = value
+
+    symptom_delay = changes.get("symptom_delay", config.symptom_delay)
+    cure_delay = changes.get("cure_delay", config.cure_delay)
+    if cure_delay < symptom_delay:
+        raise ValueError("cure_delay has to be at least symptom_delay.")
+    return changes
+
+
+def _number(key: str, value) -> float:
+    """Check that the value is a finite number that is not negative."""
+    # bool is a subclass of int
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ValueError(f"{key} has to be a number.")
+    try:
+        number: float = float(value)
+    except OverflowError:
+        raise ValueError(f"{key} is too large.")
+    if not math.isfinite(number) or number < 0:
+        raise ValueError(f"{key} has to be a positive number or zero.")
+    return number
+
+
+def export_data(guild_id: int, handle: IO[bytes], fmt: str) -> int:
+    """Write gzipped infections of the guild into a binary file.
+
+    Rows are streamed from the database and compressed as they come,
+    so the memory usage does not depend on the number of infections.
+
+    :param fmt: ``jsonl`` or ``csv``.
+    :return: Number of exported rows.
+    """
+    count: int = 0
+    with gzip.open(handle, "wt", encoding="utf-8", newline="") as output:
+        writer = None
+        if fmt == "csv":
+            writer = csv.writer(output)
+            writer.writerow(FIELDS)
+        for row in Infected.stream(guild_id):
+            values = [_encode(value) for value in row]
+            if writer is not None:
+                writer.writerow(values)
+            else:
+                output.write(json.dumps(dict(zip(FIELDS, values))) + "\n")
+            count += 1
+    return count
+
+
+def import_data(
+    guild_id: int, handle: IO[bytes], *, chunk: int = 1000
+) -> Tuple[int, int]:
+    """Insert infections from a JSON lines or CSV file into the guild.
+
+    The file may be gzipped. Rows are inserted in chunks and members that
+    already have a record are skipped, so importing a file again does
+    not change anything.
+
+    :return: Number of read rows and number of inserted rows.
+    """
+    if handle.read(2) == b"\x1f\x8b":
+        handle.seek(0)
+        handle = gzip.open(handle, "rb")
+    else:
+        handle.seek(0)
+
+    read: int = 0
+    inserted: int = 0
+    rows: List[Dict] = []
+    with io.TextIOWrapper(handle, encoding="utf-8", newline="") as text:
+        for values in _read(text):
+            rows.append(_decode(guild_id, values))
+            read += 1
+            if len(rows) >= chunk:
+                inserted += Infected.add_many(rows)
+                rows = []
+        if rows:
+            inserted += Infected.add_many(rows)
+    return read, inserted
+
+
+def _read(text: IO[str]) -> Iterator[Dict]:
+    first: str = text.readline()
+    if not first:
+        return
+    if first.lstrip().startswith("{"):
+        if first.strip():
+            yield json.loads(first)
+        for line in text:
+            if line.strip():
+                yield json.loads(line)
+        return
+
+    header: List[str] = next(csv.reader([first]))
+    for values in csv.reader(text):
+        if values:
+            yield dict(zip(header, values))
+
+
+def _encode(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    if isinstance(value, bool):
+        return int(value)
+    return value
+
+
+def _decode(guild_id: int, values: Dict) -> Dict:
+    row: Dict = {"guild_id": guild_id}
+    for key in ("user_id", "channel_id", "message_id", "infected_by"):
+        row[key] = int(values[key])
+    if row["infected_by"] == row["user_id"]:
+        raise ValueError(f"Member {row['user_id']} cannot infect themselves.")
+    infected_at: Optional[str] = values.get("infected_at", None)
+    if infected_at:
+        row["infected_at"] = datetime.datetime.fromisoformat(infected_at)
+    else:
+        row["infected_at"] = nextcord.utils.snowflake_time(row["message_id"])
+    for key in ("symptomatic", "cured"):
+        row[key] = str(values.get(key, 0)).lower() in ("1", "true")
+    return row
@@ -0,0 +1,230 @@
+import asyncio
+import collections
+import datetime
+from typing import (
+    Awaitable,
+    Callable,
+    Dict,
+    Iterable,
+    KeysView,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+)
+
+
+class GuildConfig(NamedTuple):
+    """Read-only snapshot of a guild's infection configuration."""
+
+    guild_id: int
+    role_id: int
+    probability: float
+    symptom_delay: datetime.timedelta
+    cure_delay: datetime.timedelta
+    quiet: bool
+    enabled: bool
+    starts_at: Optional[datetime.datetime] = None
+    ends_at: Optional[datetime.datetime] = None
+
+    def is_active(self, now: datetime.datetime) -> bool:
+        """Whether the infection is enabled and scheduled at given time."""
+        if not self.enabled:
+            return False
+        if self.starts_at is not None and now < self.starts_at:
+            return False
+        return self.ends_at is None or now < self.ends_at
+
+
+class ConfigCache:
+    """Write-through cache of infection configurations.
+
+    The cache holds detached snapshots, so reading them never triggers
+    a database refresh. It is updated by every write to the configuration.
+    """
+
+    def __init__(self):
+        self._configs: Dict[int, GuildConfig] = {}
+
+    def load(self, configs: Iterable) -> None:
+        """Replace the cache content with database objects."""
+        self._configs = {c.guild_id: GuildConfig(**c.dump()) for c in configs}
+
+    def update(self, config) -> GuildConfig:
+        """Store current state of a database object."""
+        snapshot = GuildConfig(**config.dump())
+        self._configs[config.guild_id] = snapshot
+        return snapshot
+
+    def invalidate(self, guild_id: int) -> None:
+        self._configs.pop(guild_id, None)
+
+    def get(self, guild_id: int) -> Optional[GuildConfig]:
+        return self._configs.get(guild_id, None)
+
+    @property
+    def guild_ids(self) -> KeysView[int]:
+        return self._configs.keys()
+
+    def any_active(self, now: datetime.datetime) -> bool:
+        return any(config.is_active(now) for config in self._configs.values())
+
+    def next_change(self, now: datetime.datetime) -> Optional[datetime.datetime]:
+        """Get the nearest scheduled start or end of an enabled infection."""
+        times = [
+            time
+            for config in self._configs.values()
+            if config.enabled
+            for time in (config.starts_at, config.ends_at)
+            if time is not None and time > now
+        ]
+        return min(times, default=None)
+
+
+config_cache = ConfigCache()
+
+
+class InfectionIndex:
+    """In-memory index of infection states.
+
+    The index holds user IDs of infected (not yet cured), symptomatic and cured
+    members for each guild, so the message path can check infection status
+    without touching the database.
+    """
+
+    def __init__(self):
+        self.infected: Dict[int, Set[int]] = {}
+        self.symptomatic: Dict[int, Set[int]] = {}
+        self.cured: Dict[int, Set[int]] = {}
+
+    def rebuild(
+        self,
+        rows: Iterable[Tuple[int, int, bool, bool]],
+        *,
+        guild_id: Optional[int] = None,
+    ) -> None:
+        """Rebuild the index from database rows.
+
+        :param rows: Iterable of ``(guild_id, user_id, symptomatic, cured)``.
+        :param guild_id: If set, only this guild is replaced.
+        """
+        if guild_id is None:
+            self.infected.clear()
+            self.symptomatic.clear()
+            self.cured.clear()
+        else:
+            self.infected.pop(guild_id, None)
+            self.symptomatic.pop(guild_id, None)
+            self.cured.pop(guild_id, None)
+
+        for row_guild_id, user_id, symptomatic, cured in rows:
+            if cured:
+                self.cured.setdefault(row_guild_id, set()).add(user_id)
+                continue
+            self.infected.setdefault(row_guild_id, set()).add(user_id)
+            if symptomatic:
+                self.symptomatic.setdefault(row_guild_id, set()).add(user_id)
+
+    def is_infected(self, guild_id: int, user_id: int) -> bool:
+        """Whether the user is infected and not yet cured."""
+        return user_id in self.infected.get(guild_id, ())
+
+    def is_symptomatic(self, guild_id: int, user_id: int) -> bool:
+        return user_id in self.symptomatic.get(guild_id, ())
+
+    def is_cured(self, guild_id: int, user_id: int) -> bool:
+        return user_id in self.cured.get(guild_id, ())
+
+    def is_known(self, guild_id: int, user_id: int) -> bool:
+        """Whether the user has ever been infected in the guild."""
+        return self.is_infected(guild_id, user_id) or self.is_cured(guild_id, user_id)
+
+    def add(self, guild_id: int, user_id: int) -> None:
+        self.infected.setdefault(guild_id, set()).add(user_id)
+
+    def set_symptomatic(self, guild_id: int, user_id: int) -> None:
+        if not self.is_infected(guild_id, user_id):
+            return
+        self.symptomatic.setdefault(guild_id, set()).add(user_id)
+
+    def set_cured(self, guild_id: int, user_id: int) -> None:
+        self.infected.get(guild_id, set()).discard(user_id)
+        self.symptomatic.get(guild_id, set()).discard(user_id)
+        self.cured.setdefault(guild_id, set()).add(user_id)
+
+    def count(self, guild_id: int) -> int:
+        """Number of members that have been infected in the guild."""
+        return len(self.infected.get(guild_id, ())) + len(self.cured.get(guild_id, ()))
+
+
+class LastMessage(NamedTuple):
+    author_id: int
+    message_id: int
+
+
+class LastMessageCache:
+    """Bounded cache of the last message in each channel.
+
+    Only the author and the message ID are stored; when the cache is full,
+    the least recently used channel is dropped. Concurrent misses on the same
+    channel share a single fetch.
+    """
+
+    def __init__(self, size: int = 10_000):
+        self.size: int = size
+        self._messages: collections.OrderedDict[int, LastMessage] = (
+            collections.OrderedDict()
+        )
+        self._fetches: Dict[int, asyncio.Future] = {}
+
+    def __len__(self) -> int:
+        return len(self._messages)
+
+    def get(self, channel_id: int) -> Optional[LastMessage]:
+        message = self._messages.get(channel_id, None)
+        if message is not None:
+            self._messages.move_to_end(channel_id)
+        return message
+
+    def set(self, channel_id: int, author_id: int, message_id: int) -> None:
+        """Store the message, unless a newer one is already known."""
+        current = self._messages.get(channel_id, None)
+        if current is not None and current.message_id > message_id:
+            return
+        self._messages[channel_id] = LastMessage(author_id, message_id)
+        self._messages.move_to_end(channel_id)
+        while len(self._messages) > self.size:
+            self._messages.popitem(last=False)
+
+    def clear(self) -> None:
+        self._messages.clear()
+
+    def seed(self, messages: Iterable) -> None:
+        """Fill the cache from already received messages."""
+        for message in messages:
+            self.set(message.channel.id, message.author.id, message.id)
+
+    async def fetch(
+        self,
+        channel_id: int,
+        fetch: Callable[[], Awaitable[Optional[LastMessage]]],
+    ) -> Optional[LastMessage]:
+        """Get the message, calling ``fetch`` if it is not cached.
+
+        Callers that miss while a fetch for the channel is in progress
+        wait for it instead of starting their own.
+        """
+        message = self.get(channel_id)
+        if message is not None:
+            return message
+
+        future: Optional[asyncio.Future] = self._fetches.get(channel_id, None)
+        if future is None:
+            future = asyncio.ensure_future(fetch())
+            self._fetches[channel_id] = future
+            future.add_done_callback(lambda _: self._fetches.pop(channel_id, None))
+            return await asyncio.shield(future)
+
+        fetched: Optional[LastMessage] = await asyncio.shield(future)
+        # The caller that started the fetch may have stored its own message
+        return self.get(channel_id) or fetched
@@ -0,0 +1,448 @@
+"""Checks of the infection module that run without Discord.
+
+Run them from the root of the bot::
+
+    python -m modules.events.infection.checks --help
+    python -m modules.events.infection.checks roles
+
+Each check prints what it measured and fails with an assertion error
+when the module does not behave as expected.
+"""
+
+import argparse
+import asyncio
+import datetime
+import multiprocessing
+import os
+import random
+import tempfile
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+import nextcord
+
+_database_path: Optional[str] = None
+
+
+def _temporary_database() -> str:
+    """Point the bot to a temporary SQLite database with the module's tables.
+
+    This has to happen before the database of pie is imported.
+
+    :return: Path to the database file.
+    """
+    global _database_path
+    if _database_path is None:
+        directory: str = tempfile.mkdtemp(prefix="infection-checks-")
+        _database_path = os.path.join(directory, "db.sqlite")
+        os.environ["DB_STRING"] = "sqlite:///" + _database_path
+
+        from pie.database import database
+
+        from . import database as tables  # noqa: F401
+
+        database.base.metadata.create_all(database.db)
+    return _database_path
+
+
+def _infections(guild_id: int, members: int, rng: random.Random) -> List[Dict]:
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return [
+        {
+            "user_id": user_id,
+            "guild_id": guild_id,
+            "channel_id": guild_id + rng.randrange(10),
+            "message_id": guild_id + user_id,
+            # Patient zero is infected by 0
+            "infected_by": rng.randrange(user_id),
+            "infected_at": now - datetime.timedelta(minutes=members - user_id),
+            "symptomatic": rng.random() < 0.3,
+            "cured": rng.random() < 0.3,
+        }
+        for user_id in range(1, members + 1)
+    ]
+
+
+class _Log:
+    """Stand-in for the pie loggers, the checks have no bot to log into."""
+
+    def __init__(self):
+        self.entries: List[str] = []
+
+    async def _log(self, actor, source, message: str, *, exception=None):
+        self.entries.append(message)
+
+    info = debug = warning = error = _log
+
+
+class _Response:
+    def __init__(self, status: int, headers: Optional[Dict[str, str]] = None):
+        self.status: int = status
+        self.reason: str = "Too Many Requests" if status == 429 else "Error"
+        self.headers: Dict[str, str] = headers or {}
+
+
+class FakeRole:
+    def __init__(self, role_id: int):
+        self.id: int = role_id
+
+    def __str__(self) -> str:
+        return f"role{self.id}"
+
+
+class FakeMember:
+    def __init__(self, user_id: int, guild: "FakeGuild"):
+        self.id: int = user_id
+        self.guild: FakeGuild = guild
+        self.roles: List[FakeRole] = []
+
+    async def add_roles(self, role: FakeRole, *, reason: str):
+        await self.guild.request()
+        self.roles.append(role)
+
+    async def remove_roles(self, role: FakeRole, *, reason: str):
+        await self.guild.request()
+        self.roles.remove(role)
+
+    def __str__(self) -> str:
+        return f"user{self.id}"
+
+
+class FakeGuild:
+    """Guild whose role endpoint answers 429 when its bucket is empty.
+
+    The bucket allows ``limit`` calls per ``window`` seconds. Some calls
+    fail with 500 to test the retries.
+    """
+
+    def __init__(self, guild_id: int, *, limit: int, window: float, rng: random.Random):
+        self.id: int = guild_id
+        self.name: str = f"guild{guild_id}"
+        self.text_channels: List[object] = [object()]
+        self.members: Dict[int, FakeMember] = {}
+        self.roles: Dict[int, FakeRole] = {}
+        self.limit: int = limit
+        self.window: float = window
+        self.rng: random.Random = rng
+        self.reset: float = 0.0
+        self.remaining: int = limit
+        self.calls: Dict[str, int] = {"ok": 0, "rate_limited": 0, "error": 0}
+
+    def get_member(self, user_id: int) -> Optional[FakeMember]:
+        return self.members.get(user_id, None)
+
+    def get_role(self, role_id: int) -> Optional[FakeRole]:
+        return self.roles.get(role_id, None)
+
+    async def request(self):
+        # Latency of the API
+        await asyncio.sleep(0.001)
+        now: float = time.monotonic()
+        if now >= self.reset:
+            self.reset = now + self.window
+            self.remaining = self.limit
+        if self.remaining == 0:
+            self.calls["rate_limited"] += 1
+            raise nextcord.HTTPException(
+                _Response(429, {"Retry-After": f"{self.reset - now:.3f}"}),
+                "You are being rate limited.",
+            )
+        self.remaining -= 1
+        if self.rng.random() < 0.05:
+            self.calls["error"] += 1
+            raise nextcord.HTTPException(_Response(500), "Internal Server Error")
+        self.calls["ok"] += 1
+
+
+class FakeBot:
+    def __init__(self):
+        self.loop = asyncio.get_running_loop()
+        self.user = None
+        self.guilds: Dict[int, FakeGuild] = {}
+
+    def get_guild(self, guild_id: int) -> Optional[FakeGuild]:
+        return self.guilds.get(guild_id, None)
+
+
+def check_roles(args: argparse.Namespace):
+    """Role queue against guilds that rate limit and fail randomly."""
+    from . import roles
+
+    roles.bot_log = roles.guild_log = _Log()
+
+    async def run():
+        rng = random.Random(args.seed)
+        bot = FakeBot()
+        queue = roles.RoleQueue(bot, workers=4, retries=8, backoff=0.01)
+        expected: Dict[FakeMember, bool] = {}
+        for guild_id in (1, 2):
+            guild = FakeGuild(guild_id, limit=10, window=0.1, rng=rng)
+            guild.roles[guild_id] = FakeRole(guild_id)
+            bot.guilds[guild_id] = guild
+            for user_id in range(args.members):
+                member = guild.members[user_id] = FakeMember(user_id, guild)
+                present: bool = rng.random() < 0.7
+                expected[member] = present
+                if present:
+                    queue.add(guild_id, user_id, guild_id)
+                    # Repeated requests are merged
+                    queue.add(guild_id, user_id, guild_id)
+                else:
+                    # Only the last request of a member counts
+                    queue.add(guild_id, user_id, guild_id)
+                    queue.remove(guild_id, user_id, guild_id)
+        requested: int = sum(expected.values())
+
+        started: float = time.monotonic()
+        queue.start()
+        await queue._queue.join()
+        elapsed: float = time.monotonic() - started
+        queue.stop()
+
+        for member, present in expected.items():
+            has_role: bool = member.guild.roles[member.guild.id] in member.roles
+            assert has_role == present, f"{member} in {member.guild.name}"
+        calls = {
+            key: sum(guild.calls[key] for guild in bot.guilds.values())
+            for key in ("ok", "rate_limited", "error")
+        }
+        print(
+            f"{requested} role changes in {elapsed:.2f} s: "
+            f"{calls['ok']} calls, {calls['rate_limited']} rate limited, "
+            f"{calls['error']} failed and retried"
+        )
+        # Nothing is called for members that end without the role
+        assert calls["ok"] == requested
+        assert calls["rate_limited"] > 0
+        # Workers wait for the bucket to reset after a 429,
+        # only the calls already in flight may hit it again
+        windows: float = elapsed / 0.1 + 1
+        assert calls["rate_limited"] <= queue.workers * windows * len(bot.guilds)
+
+    asyncio.run(run())
+
+
+def check_plans(args: argparse.Namespace):
+    """Hot queries of private_infection_data are answered from its indexes."""
+    _temporary_database()
+
+    from sqlalchemy import event
+
+    from pie.database import database
+
+    from .database import Infected
+
+    rng = random.Random(args.seed)
+    for guild_id in range(10):
+        Infected.add_many(_infections(guild_id << 32, args.members, rng))
+    guild_id: int = 5 << 32
+
+    statements: List[tuple] = []
+
+    def record(connection, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+
+    queries: Dict[str, Callable[[], object]] = {
+        "is_infected": lambda: Infected.is_infected(guild_id, 7),
+        "get": lambda: Infected.get(guild_id, 7),
+        "get_all": lambda: Infected.get_all(guild_id),
+        "get_spreaders": lambda: Infected.get_spreaders(guild_id),
+    }
+    event.listen(database.db, "before_cursor_execute", record)
+    try:
+        for name, query in queries.items():
+            statements.clear()
+            query()
+            statement, parameters = statements[-1]
+            with database.db.connect() as connection:
+                plan: List[str] = [
+                    row[-1]
+                    for row in connection.exec_driver_sql(
+                        "EXPLAIN QUERY PLAN " + statement, parameters
+                    )
+                ]
+            print(f"{name:>14}: {'; '.join(plan)}")
+            assert not any(
+                line.startswith("SCAN private_infection_data") for line in plan
+            ), f"{name} scans the table"
+            assert any(
+                "INDEX ix_private_infection_data_" in line for line in plan
+            ), f"{name} does not use an index"
+    finally:
+        event.remove(database.db, "before_cursor_execute", record)
+
+
+def check_database(args: argparse.Namespace):
+    """The event loop keeps running during a slow query."""
+    _temporary_database()
+
+    from sqlalchemy import text
+
+    from .database import run_in_db, session
+
+    def slow_query() -> int:
+        # Counting in a recursive CTE keeps SQLite busy without any data
+        return session.execute(
+            text(
+                "WITH RECURSIVE n(x) AS "
+                "(SELECT 1 UNION ALL SELECT x + 1 FROM n WHERE x < :limit) "
+                "SELECT count(*) FROM n"
+            ),
+            {"limit": 3_000_000},
+        ).scalar()
+
+    async def measure(query: Callable[[], object]) -> Tuple[float, float]:
+        """Run the query and return its duration and the longest loop stall."""
+        gaps: List[float] = []
+        running: bool = True
+
+        async def tick():
+            last: float = time.perf_counter()
+            while running:
+                await asyncio.sleep(0.005)
+                now: float = time.perf_counter()
+                gaps.append(now - last)
+                last = now
+
+        ticker = asyncio.create_task(tick())
+        await asyncio.sleep(0.02)
+        started: float = time.perf_counter()
+        await query()
+        elapsed: float = time.perf_counter() - started
+        running = False
+        await ticker
+        return elapsed, max(gaps)
+
+    async def blocking():
+        slow_query()
+
+    async def run():
+        elapsed, stall = await measure(blocking)
+        print(f"on the loop: query {elapsed:.2f} s, loop stalled {stall:.3f} s")
+        elapsed, stall = await measure(lambda: run_in_db(slow_query))
+        print(f"in database thread: query {elapsed:.2f} s, loop stalled {stall:.3f} s")
+        assert elapsed > 0.2, "the query is too fast to tell"
+        assert stall < 0.1, "the loop was blocked by the query"
+
+    asyncio.run(run())
+
+
+def _run_shard(
+    path: str, shard_id: int, shard_count: int
+) -> Tuple[List[int], List[int]]:
+    """Run the cog as a process with one shard of the bot.
+
+    :return: IDs of the loaded guilds and IDs of guilds with applied
+        transitions, once for each batch.
+    """
+    os.environ["DB_STRING"] = "sqlite:///" + path
+
+    from .module import Infection
+    from .simulator import FakeBot
+
+    async def run() -> Tuple[List[int], List[int]]:
+        bot = FakeBot()
+        bot.shard_count = shard_count
+        bot.shard_ids = [shard_id]
+        cog = Infection(bot)
+
+        processed: List[int] = []
+        transition = cog._transition
+
+        async def record(guild_id: int, items):
+            processed.append(guild_id)
+            await transition(guild_id, items)
+
+        cog._transition = record
+        # Every infection is due, the loop cures all of them on start
+        deadline: float = time.monotonic() + 60
+        while any(cog.index.infected.get(guild_id) for guild_id in cog.guilds):
+            assert time.monotonic() < deadline, "infections were not recovered"
+            await asyncio.sleep(0.05)
+        guilds: List[int] = sorted(cog.guilds)
+        cog.cog_unload()
+        return guilds, processed
+
+    return asyncio.run(run())
+
+
+def check_shards(args: argparse.Namespace):
+    """Two shard processes sharing one database never process the same guild."""
+    path: str = _temporary_database()
+
+    from .database import Infected, InfectionConfig
+    from .shards import ShardSet
+
+    rng = random.Random(args.seed)
+    # Snowflakes with random creation times, as real guild IDs
+    guild_ids: List[int] = [
+        rng.getrandbits(41) << 22 | rng.getrandbits(22) for _ in range(args.guilds)
+    ]
+    for guild_id in guild_ids:
+        InfectionConfig.add(guild_id, guild_id)
+        InfectionConfig.set(
+            guild_id,
+            symptom_delay=datetime.timedelta(minutes=1),
+            cure_delay=datetime.timedelta(minutes=2),
+            quiet=True,
+        )
+        rows: List[Dict] = _infections(guild_id, args.members, rng)
+        for row in rows:
+            row["cured"] = row["symptomatic"] = False
+            row["infected_at"] -= datetime.timedelta(hours=1)
+        Infected.add_many(rows)
+
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(2) as pool:
+        results = pool.starmap(_run_shard, [(path, 0, 2), (path, 1, 2)])
+
+    shards = ShardSet(2)
+    for shard_id, (guilds, processed) in enumerate(results):
+        print(
+            f"shard {shard_id}: {len(guilds)} guilds, "
+            f"{len(processed)} batches of transitions"
+        )
+        assert all(shards.shard_of(guild_id) == shard_id for guild_id in guilds)
+        assert set(processed) <= set(guilds)
+    (guilds_0, processed_0), (guilds_1, processed_1) = results
+    assert not set(guilds_0) & set(guilds_1), "a guild was loaded twice"
+    assert set(guilds_0) | set(guilds_1) == set(guild_ids), "a guild was left out"
+    assert not set(processed_0) & set(processed_1), "a guild was processed twice"
+    for guild_id in guild_ids:
+        assert not Infected.get_schedule(guild_id), f"guild {guild_id} not cured"
+
+
+CHECKS: Dict[str, Callable[[argparse.Namespace], None]] = {
+    "roles": check_roles,
+    "plans": check_plans,
+    "database": check_database,
+    "shards": check_shards,
+}
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(
+        prog="python -m modules.events.infection.checks",
+        description="Check the infection module without connecting to Discord.",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--members", type=int, default=200)
+    parser.add_argument("--guilds", type=int, default=40)
+    parser.add_argument(
+        "checks",
+        nargs="*",
+        metavar="CHECK",
+        help=f"checks to run: {', '.join(CHECKS)} (default: all)",
+    )
+    args = parser.parse_args(argv)
+    for name in args.checks:
+        if name not in CHECKS:
+            parser.error(f"unknown check: {name}")
+    for name in args.checks or CHECKS:
+        print(f"{name}: {CHECKS[name].__doc__}")
+        CHECKS[name](args)
+        print(f"{name}: ok")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,135 @@
 from __future__ import annotations
 
+import asyncio
 import datetime
+import functools
 import nextcord
-from typing import List, Optional, Set
+from concurrent.futures import ThreadPoolExecutor
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    TypeVar,
+)
 
-from sqlalchemy import BigInteger, Boolean, Column, Float, Integer, Interval
+from sqlalchemy import (
+    BigInteger,
+    Boolean,
+    Column,
+    DateTime,
+    Float,
+    Index,
+    Integer,
+    Interval,
+    TypeDecorator,
+    func,
+    inspect,
+    select,
+    text,
+)
 
-from pie.database import database, session
+from sqlalchemy.orm import scoped_session, sessionmaker
+
+from pie.database import database
+
+from .cache import config_cache
+from .shards import ShardSet
+
+T = TypeVar("T")
+
+# Each thread gets its own session. The objects are not expired on commit,
+# so they can be read on the event loop after the database thread is done.
+session = scoped_session(sessionmaker(bind=database.db, expire_on_commit=False))
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+async def run_in_db(func: Callable[..., T], *args, **kwargs) -> T:
+    """Run a database call in the database thread.
+
+    All calls share one thread, so they are executed in order and never
+    use the session concurrently.
+    """
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="infection")
+    return await asyncio.get_running_loop().run_in_executor(
+        _executor, functools.partial(func, *args, **kwargs)
+    )
+
+
+def shutdown_db() -> None:
+    """Stop the database thread after the queued calls are done."""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
+
+
+class _AsyncMirror:
+    """Awaitable counterpart of the classmethods of a table.
+
+    ``await AsyncInfected.get(guild_id, user_id)`` runs ``Infected.get``
+    in the database thread.
+    """
+
+    def __init__(self, table: type):
+        self._table = table
+
+    def __getattr__(self, name: str) -> Callable[..., Any]:
+        method = getattr(self._table, name)
+
+        async def call(*args, **kwargs):
+            return await run_in_db(method, *args, **kwargs)
+
+        return call
+
+
+def _chunks(values: Iterable[int], size: int = 500) -> List[List[int]]:
+    """Split values so the IN clause stays under database parameter limits."""
+    values = list(values)
+    return [values[i : i + size] for i in range(0, len(values), size)]
+
+
+class UTCDateTime(TypeDecorator):
+    """Timezone-aware UTC datetime, stored without the timezone.
+
+    SQLite drops the timezone information, so the value is normalized
+    to naive UTC on write and made aware again on read.
+    """
+
+    impl = DateTime
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is not None and value.tzinfo is not None:
+            value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+        return value
+
+    def process_result_value(self, value, dialect):
+        if value is not None and value.tzinfo is None:
+            value = value.replace(tzinfo=datetime.timezone.utc)
+        return value
+
+
+def _epoch(column):
+    """SQL expression with the column as UNIX timestamp in whole seconds."""
+    if database.db.dialect.name == "sqlite":
+        return func.cast(func.strftime("%s", column), BigInteger)
+    return func.cast(func.extract("epoch", column), BigInteger)
+
+
+def _on_shards(query, column, shards: Optional[ShardSet]):
+    """Limit the query to guilds handled by the shards of this process."""
+    if shards is None or shards.everything:
+        return query
+    shard = column.op(">>")(22) % shards.shard_count
+    return query.filter(shard.in_(sorted(shards.shard_ids)))
 
 
 class InfectionConfig(database.base):
@@ -19,15 +142,12 @@ class InfectionConfig(database.base):
     cure_delay = Column(Interval, default=datetime.timedelta(hours=12))
     quiet = Column(Boolean, default=False)
     enabled = Column(Boolean, default=True)
+    starts_at = Column(UTCDateTime, nullable=True)
+    ends_at = Column(UTCDateTime, nullable=True)
 
     @classmethod
-    def get_all(cls) -> List[InfectionConfig]:
-        return session.query(cls).all()
-
-    @classmethod
-    def get_guild_ids(cls) -> Set[int]:
-        configs = session.query(cls).all()
-        return set(c.guild_id for c in configs)
+    def get_all(cls, shards: Optional[ShardSet] = None) -> List[InfectionConfig]:
+        return _on_shards(session.query(cls), cls.guild_id, shards).all()
 
     @classmethod
     def get(cls, guild_id: int) -> Optional[InfectionConfig]:
@@ -42,6 +162,26 @@ class InfectionConfig(database.base):
         session.commit()
         return config
 
+    @classmethod
+    def set(cls, guild_id: int, **values) -> Optional[InfectionConfig]:
+        """Change the configuration in one transaction.
+
+        The object is loaded, changed and committed by the same call, so
+        it is never changed outside of the database thread. The config
+        cache is not touched here, see :data:`AsyncInfectionConfig`.
+        """
+        config = cls.get(guild_id)
+        if config is None:
+            return None
+        try:
+            for key, value in values.items():
+                setattr(config, key, value)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        return config
+
     def save(self) -> InfectionConfig:
         session.commit()
         return self
@@ -55,6 +195,8 @@ class InfectionConfig(database.base):
             "cure_delay": self.cure_delay,
             "quiet": self.quiet,
             "enabled": self.enabled,
+            "starts_at": self.starts_at,
+            "ends_at": self.ends_at,
         }
 
     def __repr__(self) -> str:
@@ -67,6 +209,20 @@ class InfectionConfig(database.base):
 
 class Infected(database.base):
     __tablename__ = "private_infection_data"
+    __table_args__ = (
+        Index(
+            "ix_private_infection_data_guild_user", "guild_id", "user_id", unique=True
+        ),
+        Index("ix_private_infection_data_guild_cured", "guild_id", "cured", "user_id"),
+        Index("ix_private_infection_data_guild_message", "guild_id", "message_id"),
+        Index("ix_private_infection_data_guild_time", "guild_id", "infected_at"),
+        Index(
+            "ix_private_infection_data_guild_infector",
+            "guild_id",
+            "infected_by",
+            "message_id",
+        ),
+    )
 
     idx = Column(Integer, primary_key=True, autoincrement=True)
     user_id = Column(BigInteger)
@@ -74,13 +230,10 @@ class Infected(database.base):
     channel_id = Column(BigInteger)
     message_id = Column(BigInteger)
     infected_by = Column(BigInteger)
+    infected_at = Column(UTCDateTime)
     symptomatic = Column(Boolean, default=False)
     cured = Column(Boolean, default=False)
 
-    @property
-    def infected_at(self) -> datetime.datetime:
-        return nextcord.Object(self.message_id).created_at
-
     @classmethod
     def is_infected(cls, guild_id: int, user_id: int) -> bool:
         query = (
@@ -101,10 +254,229 @@ class Infected(database.base):
         return query
 
     @classmethod
-    def get_spreaders(cls) -> List[Infected]:
-        query = session.query(cls).filter_by(cured=False).all()
+    def stream(cls, guild_id: int, *, chunk: int = 1000) -> Iterator[Tuple]:
+        """Iterate over (user_id, channel_id, message_id, infected_by,
+        infected_at, symptomatic, cured) of the guild's infected.
+
+        Rows are fetched from a server-side cursor in chunks, so they are
+        never all held in memory.
+        """
+        query = (
+            session.query(
+                cls.user_id,
+                cls.channel_id,
+                cls.message_id,
+                cls.infected_by,
+                cls.infected_at,
+                cls.symptomatic,
+                cls.cured,
+            )
+            .filter_by(guild_id=guild_id)
+            .order_by(cls.idx.asc())
+            .execution_options(stream_results=True)
+            .yield_per(chunk)
+        )
+        return iter(query)
+
+    @classmethod
+    def get_page(
+        cls,
+        guild_id: int,
+        *,
+        limit: int,
+        after: Optional[int] = None,
+        before: Optional[int] = None,
+        status: Optional[str] = None,
+        infected_by: Optional[int] = None,
+    ) -> List[Infected]:
+        """Get one page of infected, ordered by the infection message.
+
+        The page is selected by the message ID of the neighbouring page
+        (keyset pagination), so it is read from the index directly.
+
+        :param after: Get rows after this message ID.
+        :param before: Get rows closest before this message ID.
+        :param status: ``asymptomatic``, ``symptomatic`` or ``cured``.
+        :param infected_by: Only get members infected by this user.
+        """
+        query = session.query(cls).filter_by(guild_id=guild_id)
+        if status == "asymptomatic":
+            query = query.filter_by(symptomatic=False, cured=False)
+        elif status == "symptomatic":
+            query = query.filter_by(symptomatic=True, cured=False)
+        elif status == "cured":
+            query = query.filter_by(cured=True)
+        if infected_by is not None:
+            query = query.filter_by(infected_by=infected_by)
+
+        if before is not None:
+            query = query.filter(cls.message_id < before)
+            rows = query.order_by(cls.message_id.desc()).limit(limit).all()
+            return rows[::-1]
+        if after is not None:
+            query = query.filter(cls.message_id > after)
+        return query.order_by(cls.message_id.asc()).limit(limit).all()
+
+    @classmethod
+    def get_schedule(cls, guild_id: int) -> List[Tuple[int, datetime.datetime, bool]]:
+        """Get (user_id, infected_at, symptomatic) of members that are not cured."""
+        query = (
+            session.query(cls.user_id, cls.infected_at, cls.symptomatic)
+            .filter_by(guild_id=guild_id, cured=False)
+            .all()
+        )
+        return query
+
+    @classmethod
+    def get_due(
+        cls,
+        guild_id: int,
+        *,
+        symptoms_since: datetime.datetime,
+        cure_since: datetime.datetime,
+    ) -> Tuple[List[int], List[int]]:
+        """Get IDs of members that should have symptoms and members that should be cured.
+
+        :param symptoms_since: Members infected before this time have symptoms.
+        :param cure_since: Members infected before this time are cured.
+        """
+        symptomatic = (
+            session.query(cls.user_id)
+            .filter(
+                cls.guild_id == guild_id,
+                cls.cured.is_(False),
+                cls.symptomatic.is_(False),
+                cls.infected_at <= symptoms_since,
+                cls.infected_at > cure_since,
+            )
+            .all()
+        )
+        cured = (
+            session.query(cls.user_id)
+            .filter(
+                cls.guild_id == guild_id,
+                cls.cured.is_(False),
+                cls.infected_at <= cure_since,
+            )
+            .all()
+        )
+        return [u for (u,) in symptomatic], [u for (u,) in cured]
+
+    @classmethod
+    def get_first(cls, guild_id: int) -> Optional[Infected]:
+        query = (
+            session.query(cls)
+            .filter_by(guild_id=guild_id)
+            .order_by(cls.infected_at.asc())
+            .first()
+        )
+        return query
+
+    @classmethod
+    def get_last(cls, guild_id: int) -> Optional[Infected]:
+        query = (
+            session.query(cls)
+            .filter_by(guild_id=guild_id)
+            .order_by(cls.infected_at.desc())
+            .first()
+        )
         return query
 
+    @classmethod
+    def get_histogram(
+        cls,
+        guild_id: int,
+        *,
+        start: datetime.datetime,
+        width: datetime.timedelta,
+        offset: datetime.timedelta = datetime.timedelta(0),
+    ) -> Dict[int, int]:
+        """Count infections in time buckets.
+
+        :param start: Start of the first bucket.
+        :param width: Width of each bucket.
+        :param offset: Time added to each infection before it is counted,
+            e.g. the symptom delay to count the start of symptoms.
+        :return: Mapping of bucket number to number of infections in it.
+        """
+        width_s: int = int(width.total_seconds())
+        seconds = (
+            _epoch(cls.infected_at)
+            + int(offset.total_seconds())
+            - int(start.timestamp())
+        )
+        # Both SQLite and PostgreSQL have the same integer modulo
+        bucket = (seconds - seconds % width_s).label("bucket")
+        query = (
+            session.query(bucket, func.count(cls.idx))
+            .filter(cls.guild_id == guild_id, cls.infected_at >= start - offset)
+            .group_by(bucket)
+            .all()
+        )
+        return {int(b) // width_s: count for b, count in query}
+
+    @classmethod
+    def get_spreaders(
+        cls, guild_id: Optional[int] = None, *, shards: Optional[ShardSet] = None
+    ) -> List[Infected]:
+        query = session.query(cls).filter_by(cured=False)
+        if guild_id is not None:
+            query = query.filter_by(guild_id=guild_id)
+        return _on_shards(query, cls.guild_id, shards).all()
+
+    @classmethod
+    def get_states(
+        cls, guild_id: Optional[int] = None, *, shards: Optional[ShardSet] = None
+    ) -> List[Tuple[int, int, bool, bool]]:
+        """Get (guild_id, user_id, symptomatic, cured) of every infected."""
+        query = session.query(cls.guild_id, cls.user_id, cls.symptomatic, cls.cured)
+        if guild_id is not None:
+            query = query.filter_by(guild_id=guild_id)
+        return _on_shards(query, cls.guild_id, shards).all()
+
+    @classmethod
+    def get_transmissions(
+        cls, guild_id: Optional[int] = None, *, shards: Optional[ShardSet] = None
+    ) -> List[Tuple[int, int, int, int, datetime.datetime]]:
+        """Get (guild_id, user_id, infected_by, channel_id, infected_at)
+        of every infected, ordered by the time of infection."""
+        query = session.query(
+            cls.guild_id, cls.user_id, cls.infected_by, cls.channel_id, cls.infected_at
+        )
+        if guild_id is not None:
+            query = query.filter_by(guild_id=guild_id)
+        query = _on_shards(query, cls.guild_id, shards)
+        return query.order_by(cls.infected_at.asc(), cls.idx.asc()).all()
+
+    @classmethod
+    def update_states(
+        cls, guild_id: int, *, symptomatic: Set[int], cured: Set[int]
+    ) -> None:
+        """Mark members as symptomatic or cured in a single transaction.
+
+        Loaded objects of the members are updated too, as they are not
+        expired on commit and may still be shown by a view.
+        """
+        try:
+            for user_ids in _chunks(symptomatic):
+                session.query(cls).filter(
+                    cls.guild_id == guild_id,
+                    cls.user_id.in_(user_ids),
+                    cls.cured.is_(False),
+                ).update({cls.symptomatic: True}, synchronize_session="fetch")
+            for user_ids in _chunks(cured):
+                session.query(cls).filter(
+                    cls.guild_id == guild_id,
+                    cls.user_id.in_(user_ids),
+                ).update(
+                    {cls.symptomatic: False, cls.cured: True},
+                    synchronize_session="fetch",
+                )
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+
     @classmethod
     def get(cls, guild_id: int, user_id: int) -> Optional[Infected]:
         query = (
@@ -123,6 +495,7 @@ class Infected(database.base):
         channel_id: int,
         message_id: int,
         infected_by: int,
+        infected_at: Optional[datetime.datetime] = None,
     ) -> Optional[Infected]:
         if cls.get(guild_id, user_id):
             return None
@@ -133,11 +506,46 @@ class Infected(database.base):
             channel_id=channel_id,
             message_id=message_id,
             infected_by=infected_by,
+            infected_at=infected_at or nextcord.utils.snowflake_time(message_id),
         )
         session.add(infected)
         session.commit()
         return infected
 
+    @classmethod
+    def add_many(cls, rows: List[Dict]) -> int:
+        """Insert infections in bulk.
+
+        Members that already have a record are skipped, so the same rows can
+        be inserted repeatedly.
+
+        :param rows: Dictionaries with keyword arguments of :meth:`add`.
+        :return: Number of inserted rows.
+        """
+        guilds: Dict[int, Dict[int, Dict]] = {}
+        for row in rows:
+            guilds.setdefault(row["guild_id"], {}).setdefault(row["user_id"], row)
+
+        inserted: int = 0
+        try:
+            for guild_id, members in guilds.items():
+                existing: Set[int] = set()
+                for user_ids in _chunks(members.keys()):
+                    existing.update(
+                        user_id
+                        for (user_id,) in session.query(cls.user_id).filter(
+                            cls.guild_id == guild_id, cls.user_id.in_(user_ids)
+                        )
+                    )
+                new = [row for u, row in members.items() if u not in existing]
+                session.bulk_insert_mappings(cls, new)
+                inserted += len(new)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        return inserted
+
     def save(self):
         session.commit()
         return self
@@ -149,6 +557,7 @@ class Infected(database.base):
             "channel_id": self.channel_id,
             "message_id": self.message_id,
             "infected_by": self.infected_by,
+            "infected_at": self.infected_at,
             "symptomatic": self.symptomatic,
             "cured": self.cured,
         }
@@ -159,3 +568,106 @@ class Infected(database.base):
             + " ".join(f"{k}='{v}'" for (k, v) in self.dump().items())
             + ">"
         )
+
+
+class _AsyncConfigMirror(_AsyncMirror):
+    """Async mirror of the configuration that keeps the config cache current.
+
+    The cache is read by the event loop, so it is updated there, once the
+    database thread has returned the changed configuration.
+    """
+
+    def __getattr__(self, name: str) -> Callable[..., Any]:
+        call = super().__getattr__(name)
+        if name not in ("add", "set"):
+            return call
+
+        async def write(*args, **kwargs):
+            config = await call(*args, **kwargs)
+            if config is not None:
+                config_cache.update(config)
+            return config
+
+        return write
+
+
+AsyncInfectionConfig = _AsyncConfigMirror(InfectionConfig)
+AsyncInfected = _AsyncMirror(Infected)
+
+
+def migrate() -> None:
+    """Bring tables created by older versions of the module up to date."""
+    inspector = inspect(database.db)
+    if inspector.has_table(InfectionConfig.__tablename__):
+        config_columns: Set[str] = {
+            column["name"]
+            for column in inspector.get_columns(InfectionConfig.__tablename__)
+        }
+        for name in ("starts_at", "ends_at"):
+            if name not in config_columns:
+                _add_column(InfectionConfig.__table__.columns[name])
+
+    if not inspector.has_table(Infected.__tablename__):
+        # The table will be created with everything by create_all()
+        return
+
+    columns: Set[str] = {
+        column["name"] for column in inspector.get_columns(Infected.__tablename__)
+    }
+    if "infected_at" not in columns:
+        _add_column(Infected.__table__.c.infected_at)
+        _backfill_infected_at()
+
+    existing: Set[str] = {
+        index["name"] for index in inspector.get_indexes(Infected.__tablename__)
+    }
+    missing: List[Index] = [
+        index for index in Infected.__table__.indexes if index.name not in existing
+    ]
+    if not missing:
+        return
+
+    if any(index.unique for index in missing):
+        # Keep the first infection of each member, the unique index would fail
+        first = select(func.min(Infected.idx)).group_by(
+            Infected.guild_id, Infected.user_id
+        )
+        session.query(Infected).filter(Infected.idx.not_in(first)).delete(
+            synchronize_session=False
+        )
+    session.commit()
+
+    for index in missing:
+        index.create(bind=database.db)
+
+
+def _add_column(column: Column) -> None:
+    column_type: str = column.type.compile(dialect=database.db.dialect)
+    with database.db.begin() as connection:
+        connection.execute(
+            text(
+                f"ALTER TABLE {column.table.name} "
+                f"ADD COLUMN {column.name} {column_type}"
+            )
+        )
+
+
+def _backfill_infected_at(batch: int = 1000) -> None:
+    """Fill in infection time of old rows from their message snowflakes."""
+    while True:
+        rows = (
+            session.query(Infected.idx, Infected.message_id)
+            .filter(Infected.infected_at.is_(None))
+            .limit(batch)
+            .all()
+        )
+        if not rows:
+            return
+        session.bulk_update_mappings(
+            Infected,
+            [
+                {"idx": idx, "infected_at": nextcord.utils.snowflake_time(message_id)}
+                for idx, message_id in rows
+            ],
+        )
+        session.commit()
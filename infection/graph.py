@@ -0,0 +1,152 @@
+import asyncio
+import collections
+import functools
+import io
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Hashable, List, Optional, Tuple
+
+import pygal
+
+# More points would not be readable, and the series are built on the event loop
+MAX_POINTS: int = 2000
+
+
+def cumulative(histogram: Dict[int, int], buckets: int, *, first: int = 0) -> List[int]:
+    """Turn bucket counts into running totals.
+
+    :param histogram: Mapping of bucket number to count. Buckets before
+        ``first`` are counted into the first one.
+    :param buckets: Number of the bucket after the last one in the output.
+    :param first: Number of the first bucket in the output.
+    :return: Total count at the end of each bucket from ``first`` on.
+    """
+    total: int = sum(count for bucket, count in histogram.items() if bucket < first)
+    series: List[int] = []
+    for bucket in range(first, buckets):
+        total += histogram.get(bucket, 0)
+        series.append(total)
+    return series
+
+
+def render(
+    *,
+    title: str,
+    x_title: str,
+    y_title: str,
+    labels: List[int],
+    series: Dict[str, List[int]],
+) -> bytes:
+    """Render line chart into PNG."""
+    chart = pygal.Line(show_legend=len(series) > 1)
+
+    chart.title = title
+    chart.width = 1200
+    chart.height = 600
+
+    chart.x_labels = labels
+    chart.x_title = x_title
+    chart.y_title = y_title
+    chart.interpolate = "cubic"
+    chart._min = 0
+    for name, values in series.items():
+        chart.add(name, values)
+
+    with io.BytesIO() as f:
+        chart.render_to_png(f)
+        return f.getvalue()
+
+
+class ChartRenderer:
+    """Render charts in worker processes and cache the results.
+
+    Rasterizing a chart takes hundreds of milliseconds, so it must not run on
+    the event loop. At most ``queue_size`` charts are rendered or waiting
+    at a time, further requests are refused.
+
+    :param workers: Number of worker processes.
+    :param queue_size: Maximal number of charts being rendered at once.
+    :param cache_size: Maximal number of cached charts.
+    :param cache_ttl: Number of seconds a chart is kept in the cache.
+    """
+
+    def __init__(
+        self,
+        *,
+        workers: int = 1,
+        queue_size: int = 4,
+        cache_size: int = 32,
+        cache_ttl: float = 600.0,
+    ):
+        self.workers: int = workers
+        self.queue_size: int = queue_size
+        self.cache_size: int = cache_size
+        self.cache_ttl: float = cache_ttl
+
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._pending: int = 0
+        self._cache: collections.OrderedDict[Hashable, Tuple[float, bytes]] = (
+            collections.OrderedDict()
+        )
+
+    @property
+    def full(self) -> bool:
+        return self._pending >= self.queue_size
+
+    def get(self, key: Hashable) -> Optional[bytes]:
+        """Get cached chart, if it has not expired yet."""
+        item = self._cache.get(key, None)
+        if item is None:
+            return None
+        expires_at, image = item
+        if expires_at < time.monotonic():
+            del self._cache[key]
+            return None
+        self._cache.move_to_end(key)
+        return image
+
+    def _put(self, key: Hashable, image: bytes):
+        self._cache[key] = (time.monotonic() + self.cache_ttl, image)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    async def render(self, key: Hashable, **kwargs) -> Optional[bytes]:
+        """Render the chart, unless it is cached.
+
+        :param key: Cache key; it should change whenever the data change.
+        :param kwargs: Arguments of :func:`render`.
+        :return: PNG image or ``None`` if the queue is full.
+        """
+        image = self.get(key)
+        if image is not None:
+            return image
+        if self.full:
+            return None
+
+        if self._executor is None:
+            # The bot runs other threads by now, forking it could deadlock
+            # the worker and would copy its memory and sockets
+            methods: List[str] = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context(
+                "forkserver" if "forkserver" in methods else "spawn"
+            )
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=context
+            )
+        self._pending += 1
+        try:
+            image = await asyncio.get_running_loop().run_in_executor(
+                self._executor, functools.partial(render, **kwargs)
+            )
+        finally:
+            self._pending -= 1
+        self._put(key, image)
+        return image
+
+    def close(self):
+        self._cache.clear()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
@@ -0,0 +1,166 @@
+import bisect
+from typing import Dict, Iterable, List, Tuple
+
+
+class Counter:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value: int = 0
+
+    def inc(self, amount: int = 1) -> None:
+        self.value += amount
+
+
+class CounterFamily:
+    """Counters sharing a name, distinguished by one label.
+
+    All label values are created up front, so counting is a dictionary
+    lookup and an integer addition.
+    """
+
+    def __init__(self, name: str, help: str, label: str, values: Iterable[str]):
+        self.name: str = name
+        self.help: str = help
+        self.label: str = label
+        self.counters: Dict[str, Counter] = {value: Counter() for value in values}
+
+    def __getitem__(self, value: str) -> Counter:
+        return self.counters[value]
+
+    def expose(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for value, counter in self.counters.items():
+            lines.append(f'{self.name}{{{self.label}="{value}"}} {counter.value}')
+        return lines
+
+
+class Histogram:
+    """Latency histogram with fixed buckets.
+
+    Durations are observed in integer nanoseconds, as returned by
+    :func:`time.perf_counter_ns`, and exposed in seconds.
+    """
+
+    def __init__(self, name: str, help: str, buckets: Tuple[float, ...]):
+        self.name: str = name
+        self.help: str = help
+        self.buckets: Tuple[float, ...] = buckets
+        self._bounds: List[int] = [int(b * 1e9) for b in buckets]
+        # The last item counts observations above the highest bucket
+        self.counts: List[int] = [0] * (len(buckets) + 1)
+        self.sum: int = 0
+
+    def observe(self, nanoseconds: int) -> None:
+        self.counts[bisect.bisect_left(self._bounds, nanoseconds)] += 1
+        self.sum += nanoseconds
+
+    def expose(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        total: int = 0
+        for bucket, count in zip(self.buckets, self.counts):
+            total += count
+            lines.append(f'{self.name}_bucket{{le="{bucket}"}} {total}')
+        total += self.counts[-1]
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {total}')
+        lines.append(f"{self.name}_sum {self.sum / 1e9}")
+        lines.append(f"{self.name}_count {total}")
+        return lines
+
+
+_FAST = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5)
+_SLOW = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class InfectionMetrics:
+    """Counters and latency histograms of the infection module."""
+
+    def __init__(self):
+        self.messages = CounterFamily(
+            "infection_messages_total",
+            "Guild messages handled by on_message, by where the handler returned.",
+            "result",
+            (
+                "bot",
+                "unregistered",
+                "disabled",
+                "no_previous",
+                "infected",
+                "previous_healthy",
+                "roll_failed",
+                "cured",
+                "infection",
+            ),
+        )
+        self.message_cache = CounterFamily(
+            "infection_message_cache_total",
+            "Lookups of the previous message in a channel.",
+            "result",
+            ("hit", "miss"),
+        )
+        self.history_fetches = CounterFamily(
+            "infection_history_fetches_total",
+            "Channel history requests for the previous message.",
+            "result",
+            ("found", "empty"),
+        )
+        self.message_latency = Histogram(
+            "infection_message_seconds",
+            "Time spent in on_message.",
+            _FAST,
+        )
+        self.loop_rows = CounterFamily(
+            "infection_loop_rows_total",
+            "Due transitions handled by the infection loop.",
+            "transition",
+            ("SYMPTOMS", "CURE"),
+        )
+        self.transitions = CounterFamily(
+            "infection_transitions_total",
+            "Members whose state was changed by the infection loop.",
+            "transition",
+            ("SYMPTOMS", "CURE"),
+        )
+        self.role_calls = CounterFamily(
+            "infection_role_calls_total",
+            "Role API calls made by the role workers.",
+            "result",
+            ("ok", "rate_limited", "error"),
+        )
+        self.loop_latency = Histogram(
+            "infection_loop_seconds",
+            "Duration of one infection loop cycle.",
+            _SLOW,
+        )
+        self.graphs = CounterFamily(
+            "infection_graphs_total",
+            "Infection graph requests.",
+            "result",
+            ("cached", "rendered", "rejected"),
+        )
+        self.graph_latency = Histogram(
+            "infection_graph_seconds",
+            "Time spent rendering an infection graph.",
+            _SLOW,
+        )
+
+    def expose(self) -> str:
+        """Get all metrics in the Prometheus text exposition format."""
+        lines: List[str] = []
+        for metric in (
+            self.messages,
+            self.message_cache,
+            self.history_fetches,
+            self.message_latency,
+            self.loop_rows,
+            self.transitions,
+            self.role_calls,
+            self.loop_latency,
+            self.graphs,
+            self.graph_latency,
+        ):
+            lines += metric.expose()
+        return "\n".join(lines) + "\n"
+
+
+metrics = InfectionMetrics()
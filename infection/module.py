@@ -1,121 +1,423 @@
+import asyncio
 import datetime
 import io
+import os
 import random
-from typing import Callable, Dict, List, Set, Optional
-
-import pygal
+import tempfile
+import time
+from typing import Dict, KeysView, List, Optional, Set
 
 import nextcord
 from nextcord.ext import commands, tasks
 
-import pie._tracing
 from pie import check, i18n, logger, utils
 
-from .database import InfectionConfig, Infected
+from . import archive, graph
+from .cache import InfectionIndex, LastMessage, LastMessageCache, config_cache
+from .database import (
+    AsyncInfected,
+    AsyncInfectionConfig,
+    InfectionConfig,
+    Infected,
+    migrate,
+    run_in_db,
+    shutdown_db,
+)
+from .metrics import metrics
+from .roles import RoleQueue
+from .scheduler import Due, Transition, TransitionScheduler, utcnow
+from .shards import ShardSet
+from .stats import GuildStats, TransmissionStats
+from .tracing import Tracer
+from .views import InfectionListView
 
 _ = i18n.Translator("modules/events").translate
 bot_log = logger.Bot.logger()
 guild_log = logger.Guild.logger()
 
-_trace: Callable = pie._tracing.register("private_infection")
+_trace = Tracer("private_infection")
 
 
 class Infection(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
 
-        self.guilds: Set[int] = InfectionConfig.get_guild_ids()
-        self.message_cache: Dict[nextcord.Channel, nextcord.Message] = {}
-
-        self.infection_loop.start()
+        # Guilds on other shards are handled by other processes
+        self.shards = ShardSet.from_bot(bot)
+
+        # Loading happens once before the bot connects, it can block
+        migrate()
+        config_cache.load(InfectionConfig.get_all(self.shards))
+        self.message_cache = LastMessageCache()
+
+        self.index = InfectionIndex()
+        self.index.rebuild(Infected.get_states(shards=self.shards))
+        self.stats = TransmissionStats()
+        self.stats.rebuild(Infected.get_transmissions(shards=self.shards))
+
+        self.roles = RoleQueue(bot)
+        self.roles.start()
+        self.graphs = graph.ChartRenderer()
+        # New infections waiting to be written into the database;
+        # the flush loop runs while the message listener is registered
+        self.pending: List[Dict] = []
+
+        self.scheduler = TransitionScheduler()
+        self.infection_task = self.bot.loop.create_task(self.infection_loop())
+        self.infection_task.add_done_callback(self._infection_loop_done)
+
+        # File for the textfile collector of a local Prometheus node exporter
+        self.metrics_file: Optional[str] = os.getenv("INFECTION_METRICS_FILE")
+        if self.metrics_file:
+            self.metrics_loop.start()
+
+        # The message listener is only registered during an event
+        self.listening: bool = False
+        self._activation_timer: Optional[asyncio.TimerHandle] = None
+        self.update_activation()
+        # Messages received before the cog was (re)loaded; activation
+        # clears the cache, so they are added after it
+        self.message_cache.seed(
+            m
+            for m in self.bot.cached_messages
+            if m.guild is not None and m.guild.id in self.guilds
+        )
 
     #
 
     def cog_unload(self):
-        self.infection_loop.cancel()
+        if self._activation_timer is not None:
+            self._activation_timer.cancel()
+        if self.listening:
+            self.bot.remove_listener(self.on_message, "on_message")
+        self.flush_loop.cancel()
+        self.metrics_loop.cancel()
+        self.infection_task.cancel()
+        self.roles.stop()
+        self.graphs.close()
+        # Let the queued calls finish, then save the rest synchronously
+        shutdown_db()
+        if self.pending:
+            Infected.add_many(self.pending)
+            self.pending = []
+
+    @property
+    def guilds(self) -> KeysView[int]:
+        """IDs of guilds with initiated infection on the local shards."""
+        return config_cache.guild_ids
+
+    def update_activation(self):
+        """Register the message listener while some guild has an active event.
+
+        Between events the cog does not see messages at all. The next
+        scheduled start or end of an event is waited for with a timer.
+        """
+        now = utcnow()
+        active: bool = config_cache.any_active(now)
+        if active and not self.listening:
+            # Messages were not followed, the cached ones are outdated
+            self.message_cache.clear()
+            self.bot.add_listener(self.on_message, "on_message")
+            self.listening = True
+            self._start_flush_loop()
+            _trace("Infection message listener registered.")
+        elif not active and self.listening:
+            self.bot.remove_listener(self.on_message, "on_message")
+            self.listening = False
+            self.flush_loop.stop()
+            _trace("Infection message listener removed.")
+
+        if self._activation_timer is not None:
+            self._activation_timer.cancel()
+            self._activation_timer = None
+        change: Optional[datetime.datetime] = config_cache.next_change(now)
+        if change is not None:
+            self._activation_timer = self.bot.loop.call_later(
+                (change - now).total_seconds(), self.update_activation
+            )
+
+    async def rebuild_index(self, guild_id: Optional[int] = None):
+        """Load infection states from the database into the in-memory index."""
+        await self.flush_infections()
+        states = await AsyncInfected.get_states(guild_id, shards=self.shards)
+        self.index.rebuild(states, guild_id=guild_id)
+        transmissions = await AsyncInfected.get_transmissions(
+            guild_id, shards=self.shards
+        )
+        self.stats.rebuild(transmissions, guild_id=guild_id)
+
+    async def schedule_guild(self, guild_id: int):
+        """Recompute symptom and cure deadlines of all spreaders in a guild."""
+        config = config_cache.get(guild_id)
+        if not config:
+            return
+        spreaders = await AsyncInfected.get_schedule(guild_id)
+        # Infections that have not been saved yet
+        spreaders += [
+            (row["user_id"], row["infected_at"], False)
+            for row in self.pending
+            if row["guild_id"] == guild_id
+        ]
+        self.scheduler.reschedule(
+            guild_id,
+            spreaders,
+            symptom_delay=config.symptom_delay,
+            cure_delay=config.cure_delay,
+        )
+
+    def register_infection(
+        self,
+        guild_id: int,
+        user_id: int,
+        *,
+        infected_by: int,
+        channel_id: int,
+        infected_at: datetime.datetime,
+    ):
+        """Add new infection to the index and schedule its transitions."""
+        self.index.add(guild_id, user_id)
+        self.stats.add(guild_id, user_id, infected_by, channel_id, infected_at)
+        config = config_cache.get(guild_id)
+        if not config:
+            return
+        self.scheduler.schedule(
+            guild_id,
+            user_id,
+            infected_at,
+            symptom_delay=config.symptom_delay,
+            cure_delay=config.cure_delay,
+        )
+
+    async def flush_infections(self):
+        """Write pending infections into the database."""
+        if not self.pending:
+            return
+        rows, self.pending = self.pending, []
+        try:
+            await AsyncInfected.add_many(rows)
+        except Exception:
+            # Keep them for the next attempt
+            self.pending = rows + self.pending
+            raise
+        _trace("Flushed {} new infections.", len(rows))
+
+    @tasks.loop(seconds=10)
+    async def flush_loop(self):
+        try:
+            await self.flush_infections()
+        except Exception as exc:
+            await bot_log.error(
+                self.bot.user,
+                None,
+                f"Could not save {len(self.pending)} new infections.",
+                exception=exc,
+            )
+
+    @flush_loop.before_loop
+    async def before_flush_loop(self):
+        # Let the first batch fill up
+        await asyncio.sleep(self.flush_loop.seconds)
+
+    @flush_loop.after_loop
+    async def after_flush_loop(self):
+        if self.flush_loop.is_being_cancelled():
+            # The cog is being unloaded, it saves the rest by itself
+            return
+        # Infections from messages handled while the loop was stopping
+        try:
+            await self.flush_infections()
+        except Exception as exc:
+            await bot_log.error(
+                self.bot.user,
+                None,
+                f"Could not save {len(self.pending)} new infections.",
+                exception=exc,
+            )
+        # The listener may have been registered again in the meantime,
+        # the loop can only be started once this task is done
+        self.bot.loop.call_soon(self._start_flush_loop)
+
+    def _start_flush_loop(self):
+        if self.listening and not self.flush_loop.is_running():
+            self.flush_loop.start()
+
+    @tasks.loop(minutes=1)
+    async def metrics_loop(self):
+        # Replace the file at once, so the scraper never reads half of it
+        with open(self.metrics_file + ".tmp", "w") as handle:
+            handle.write(metrics.expose())
+        os.replace(self.metrics_file + ".tmp", self.metrics_file)
 
-    @tasks.loop(minutes=5)
     async def infection_loop(self):
-        _trace("Running infection loop.")
-        spreaders = Infected.get_spreaders()
-        configs = {c.guild_id: c for c in InfectionConfig.get_all()}
-        now = datetime.datetime.utcnow().replace(tzinfo=datetime.timezone.utc)
-
-        for spreader in spreaders:
-            config = configs[spreader.guild_id]
-            guild = self.bot.get_guild(spreader.guild_id)
-
-            member = guild.get_member(spreader.user_id)
-            if not member:
-                await guild_log.debug(
+        """Apply symptom and cure transitions when they are due."""
+        await self.bot.wait_until_ready()
+        try:
+            await self._reload_shards()
+        except Exception as exc:
+            await bot_log.error(
+                self.bot.user,
+                None,
+                "Could not reload infections of the local shards.",
+                exception=exc,
+            )
+        _trace("Infection loop running on {!r}.", self.shards)
+        for guild_id in list(self.guilds):
+            try:
+                await self._recover(guild_id)
+                await self.schedule_guild(guild_id)
+            except Exception as exc:
+                await bot_log.error(
                     self.bot.user,
-                    guild.text_channels[0],
-                    f"Could not find user {spreader.user_id}.",
+                    None,
+                    f"Could not schedule infection transitions in guild {guild_id}.",
+                    exception=exc,
                 )
-                continue
-
-            role = guild.get_role(config.role_id)
-            if not role:
-                await guild_log.error(
+        while True:
+            due: List[Due] = await self.scheduler.wait()
+            start: int = time.perf_counter_ns()
+            _trace("Running infection loop with {} due transitions.", len(due))
+            # The transitions are applied with UPDATE, the rows have to exist
+            try:
+                await self.flush_infections()
+            except Exception as exc:
+                await bot_log.error(
                     self.bot.user,
-                    guild.text_channels[0],
-                    f"Could not find role {config.role_id}.",
+                    None,
+                    f"Could not save {len(self.pending)} new infections.",
+                    exception=exc,
                 )
-                continue
-
-            delta: datetime.timedelta = now - spreader.infected_at
-
-            if delta > config.symptom_delay and not spreader.cured:
-                # Add symptoms, if there weren't before
-                spreader.symptomatic = True
-                if role not in member.roles and not config.quiet:
-                    try:
-                        await member.add_roles(role, reason="Infection")
-                        await guild_log.info(
-                            self.bot.user,
-                            guild.text_channels[0],
-                            f"Adding infected role to {member}.",
-                        )
-                    except nextcord.Forbidden:
-                        await guild_log.debug(
-                            self.bot.user,
-                            guild.text_channels[0],
-                            f"Cannot add role {role} to {member}: permission denied.",
-                        )
-            elif delta < config.cure_delay:
-                _trace(
-                    f"Member {member}@{member.guild.name} without symptoms so far, "
-                    f"delta {delta} < {config.symptom_delay}."
-                )
-            if delta > config.cure_delay:
-                # Remove symptoms, the member is cured
-                spreader.symptomatic = False
-                spreader.cured = True
-                if role in member.roles and not config.quiet:
-                    try:
-                        await member.remove_roles(role, reason="Cured")
-                    except nextcord.Forbidden:
-                        await guild_log.debug(
-                            self.bot.user,
-                            guild.text_channels[0],
-                            f"Cannot remove role {role} from {member}: permission denied.",
-                        )
-                    await guild_log.info(
+            guilds: Dict[int, List[Due]] = {}
+            for item in due:
+                metrics.loop_rows[item.transition.name].inc()
+                guilds.setdefault(item.guild_id, []).append(item)
+            for guild_id, items in guilds.items():
+                try:
+                    await self._transition(guild_id, items)
+                except Exception as exc:
+                    await bot_log.error(
                         self.bot.user,
-                        guild.text_channels[0],
-                        f"Removing infected role from {member}@{member.guild.name}.",
+                        None,
+                        f"Could not apply infection transitions in guild {guild_id}.",
+                        exception=exc,
                     )
-            elif delta > config.symptom_delay:
-                _trace(
-                    f"Member {member}@{member.guild.name} with symptoms so far, "
-                    f"delta {delta} < {config.cure_delay}."
-                )
-            spreader.save()
+            metrics.loop_latency.observe(time.perf_counter_ns() - start)
 
-    @infection_loop.before_loop
-    async def before_infection_loop(self):
-        if not self.bot.is_ready():
-            await self.bot.wait_until_ready()
+    def _infection_loop_done(self, task: asyncio.Task):
+        if task.cancelled():
+            return
+        # The loop never returns, this is a bug
+        self.bot.loop.create_task(
+            bot_log.error(
+                self.bot.user,
+                None,
+                "Infection loop stopped, transitions will not be applied.",
+                exception=task.exception(),
+            )
+        )
+
+    async def _reload_shards(self):
+        # The shard count of an auto-sharded bot is only known once it connects
+        shards = ShardSet.from_bot(self.bot)
+        if (shards.shard_count, shards.shard_ids) == (
+            self.shards.shard_count,
+            self.shards.shard_ids,
+        ):
+            return
+        self.shards = shards
+        config_cache.load(await AsyncInfectionConfig.get_all(self.shards))
+        self.update_activation()
+        await self.rebuild_index()
+
+    async def _recover(self, guild_id: int):
+        """Apply transitions that were missed while the bot was offline."""
+        config = config_cache.get(guild_id)
+        now = datetime.datetime.now(datetime.timezone.utc)
+        symptomatic, cured = await AsyncInfected.get_due(
+            guild_id,
+            symptoms_since=now - config.symptom_delay,
+            cure_since=now - config.cure_delay,
+        )
+        items: List[Due] = [
+            Due(guild_id, user_id, Transition.SYMPTOMS) for user_id in symptomatic
+        ] + [Due(guild_id, user_id, Transition.CURE) for user_id in cured]
+        if items:
+            _trace(
+                "Recovering {} missed transitions in guild {}.", len(items), guild_id
+            )
+            await self._transition(guild_id, items)
+        self._reconcile_roles(guild_id)
+
+    def _reconcile_roles(self, guild_id: int):
+        """Queue role changes of members whose role does not match their state.
+
+        Role changes are given up after a few attempts and the queue is
+        dropped when the cog is unloaded, so the roles are checked again
+        on every start.
+        """
+        config = config_cache.get(guild_id)
+        if not config or config.quiet:
+            return
+        guild: Optional[nextcord.Guild] = self.bot.get_guild(guild_id)
+        role: Optional[nextcord.Role] = (
+            guild.get_role(config.role_id) if guild else None
+        )
+        if not role:
+            return
+        for user_id in self.index.symptomatic.get(guild_id, ()):
+            member: Optional[nextcord.Member] = guild.get_member(user_id)
+            if member is not None and role not in member.roles:
+                self.roles.add(guild_id, user_id, role.id)
+        for member in role.members:
+            if self.index.is_cured(guild_id, member.id):
+                self.roles.remove(guild_id, member.id, role.id)
+
+    async def _transition(self, guild_id: int, items: List[Due]):
+        config = config_cache.get(guild_id)
+        if not config:
+            return
+
+        # Rows that do not change state are skipped entirely
+        cured: Set[int] = {
+            item.user_id
+            for item in items
+            if item.transition == Transition.CURE
+            and self.index.is_infected(guild_id, item.user_id)
+        }
+        symptomatic: Set[int] = {
+            item.user_id
+            for item in items
+            if item.transition == Transition.SYMPTOMS
+            and item.user_id not in cured
+            and self.index.is_infected(guild_id, item.user_id)
+            and not self.index.is_symptomatic(guild_id, item.user_id)
+        }
+        if not symptomatic and not cured:
+            return
+
+        await AsyncInfected.update_states(
+            guild_id, symptomatic=symptomatic, cured=cured
+        )
+        for user_id in symptomatic:
+            self.index.set_symptomatic(guild_id, user_id)
+        for user_id in cured:
+            self.index.set_cured(guild_id, user_id)
+        metrics.transitions["SYMPTOMS"].inc(len(symptomatic))
+        metrics.transitions["CURE"].inc(len(cured))
+        _trace(
+            "Guild {}: {} symptomatic, {} cured.",
+            guild_id,
+            len(symptomatic),
+            len(cured),
+        )
+
+        if config.quiet:
+            return
+
+        # Role changes are handled in the background
+        for user_id in symptomatic:
+            self.roles.add(guild_id, user_id, config.role_id)
+        for user_id in cured:
+            self.roles.remove(guild_id, user_id, config.role_id)
 
     #
 
@@ -131,7 +433,7 @@ class Infection(commands.Cog):
     async def infection_check(self, ctx):
         """Check for infection."""
         infected: bool
-        user = Infected.get(ctx.guild.id, ctx.author.id)
+        user = await AsyncInfected.get(ctx.guild.id, ctx.author.id)
         if not user or (not user.symptomatic and not user.cured):
             await ctx.reply(_(ctx, "You don't seem to have any symptoms."))
             return
@@ -177,99 +479,397 @@ class Infection(commands.Cog):
 
     @check.acl2(check.ACLevel.MOD)
     @infection_.command(name="list")
-    async def infection_list(self, ctx):
-        """List infected members."""
-        users = Infected.get_all(ctx.guild.id)
-
-        class Item:
-            def __init__(self, bot: commands.Bot, user: Infected):
-                dc_user = bot.get_user(user.user_id)
-                self.name = getattr(dc_user, "name", user.user_id)
-                self.infected_at = utils.time.format_datetime(user.infected_at)
-                if user.infected_by == 0:
-                    self.infected_by = _(ctx, "(patient zero)")
-                else:
-                    infected_by = bot.get_user(user.infected_by)
-                    self.infected_by = getattr(infected_by, "name", user.infected_by)
-                if not user.symptomatic and not user.cured:
-                    self.status = _(ctx, "Asymptomatic")
-                elif not user.cured:
-                    self.status = _(ctx, "Symptomatic")
-                else:
-                    self.status = _(ctx, "Cured")
-
-        items = [Item(self.bot, user) for user in users]
-        table: List[str] = utils.text.create_table(
-            items,
-            header={
-                "name": _(ctx, "Name"),
-                "infected_at": _(ctx, "Infected at"),
-                "infected_by": _(ctx, "Infected by"),
-                "status": _(ctx, "Status"),
-            },
-        )
-
-        for page in table:
-            await ctx.send("```" + page + "```")
+    async def infection_list(
+        self,
+        ctx,
+        status: str = "all",
+        infected_by: Optional[nextcord.User] = None,
+    ):
+        """List infected members.
+
+        status: all, asymptomatic, symptomatic or cured.
+        infected_by: Only list members infected by this user.
+        """
+        status = status.lower()
+        if status not in ("all", "asymptomatic", "symptomatic", "cured"):
+            await ctx.reply(
+                _(
+                    ctx,
+                    "Status has to be one of: all, asymptomatic, symptomatic, cured.",
+                )
+            )
+            return
+
+        await self.flush_infections()
+        view = InfectionListView(
+            ctx,
+            status=None if status == "all" else status,
+            infected_by=getattr(infected_by, "id", None),
+        )
+        if not await view.load():
+            await ctx.reply(_(ctx, "No one has been infected."))
+            return
+        view.message = await ctx.reply(view.render(), view=view)
 
     @check.acl2(check.ACLevel.MOD)
     @infection_.command(name="graph")
-    async def infection_graph(self, ctx):
-        """Show infection graphs."""
-        everyone = Infected.get_all(ctx.guild.id)
-        if not everyone:
+    async def infection_graph(
+        self, ctx, width: int = 5, start: int = 0, end: Optional[int] = None
+    ):
+        """Show infection graphs.
+
+        width: Length of one step in minutes.
+        start: Start of the graph in minutes since patient zero.
+        end: End of the graph in minutes since patient zero.
+        """
+        config = config_cache.get(ctx.guild.id)
+        if not config:
+            await ctx.reply(_(ctx, "Config not initiated."))
+            return
+        if width < 1 or start < 0 or (end is not None and end <= start):
+            await ctx.reply(_(ctx, "Invalid time range."))
+            return
+        if end is not None and (end - start) / width > graph.MAX_POINTS:
+            await ctx.reply(
+                _(ctx, "The graph would have too many points, use a longer step.")
+            )
+            return
+
+        await self.flush_infections()
+        patient_zero = await AsyncInfected.get_first(ctx.guild.id)
+        if not patient_zero:
+            await ctx.reply(_(ctx, "No one has been infected."))
+            return
+
+        # The chart is the same until someone gets infected
+        last = await AsyncInfected.get_last(ctx.guild.id)
+        key = (
+            ctx.guild.id,
+            self.index.count(ctx.guild.id),
+            last.infected_at,
+            width,
+            start,
+            end,
+            _(ctx, "Infection spread"),
+        )
+        image: Optional[bytes] = self.graphs.get(key)
+        if image is not None:
+            metrics.graphs["cached"].inc()
+        elif not self.graphs.full:
+            start_ns: int = time.perf_counter_ns()
+            zero: datetime.datetime = patient_zero.infected_at
+            now = datetime.datetime.now(datetime.timezone.utc)
+            if end is None:
+                end = max(int((now - zero).total_seconds() // 60), start + width)
+                if (end - start) / width > graph.MAX_POINTS:
+                    await ctx.reply(
+                        _(
+                            ctx,
+                            "The graph would have too many points, use a longer step.",
+                        )
+                    )
+                    return
+
+            async with ctx.typing():
+                # The series are cumulative, everything before the start counts
+                first: int = start // width
+                buckets: int = -(-end // width)
+                step = datetime.timedelta(minutes=width)
+                infected, symptoms, cured = [
+                    graph.cumulative(
+                        await AsyncInfected.get_histogram(
+                            ctx.guild.id, start=zero, width=step, offset=offset
+                        ),
+                        buckets,
+                        first=first,
+                    )
+                    for offset in (
+                        datetime.timedelta(0),
+                        config.symptom_delay,
+                        config.cure_delay,
+                    )
+                ]
+                # Transitions are only known up to now
+                past: int = max(int((now - zero) / step) + 1 - first, 0)
+                symptoms = symptoms[:past]
+                cured = cured[:past]
+                symptomatic = [s - c for s, c in zip(symptoms, cured)]
+
+                image = await self.graphs.render(
+                    key,
+                    title=_(ctx, "Infection spread"),
+                    x_title=_(ctx, "Minutes since patient zero"),
+                    y_title=_(ctx, "# of infected"),
+                    labels=[(b + 1) * width for b in range(first, buckets)],
+                    series={
+                        _(ctx, "Infected"): infected,
+                        _(ctx, "Symptomatic"): symptomatic,
+                        _(ctx, "Cured"): cured,
+                    },
+                )
+            if image is not None:
+                metrics.graphs["rendered"].inc()
+                metrics.graph_latency.observe(time.perf_counter_ns() - start_ns)
+        if image is None:
+            metrics.graphs["rejected"].inc()
+            await ctx.reply(_(ctx, "Too many graphs are being drawn, try again later."))
+            return
+
+        with io.BytesIO(image) as f:
+            await ctx.reply(
+                file=nextcord.File(fp=f, filename="Infection statistics.png"),
+                mention_author=False,
+            )
+
+    @check.acl2(check.ACLevel.MOD)
+    @infection_.command(name="tree")
+    async def infection_tree(self, ctx, member: Optional[nextcord.Member] = None):
+        """Show the transmission chain of a member."""
+        member = member or ctx.author
+        stats: Optional[GuildStats] = self.stats.get(ctx.guild.id)
+        chain: List[int] = stats.chain(member.id) if stats else []
+        if not chain:
+            await ctx.reply(_(ctx, "That member has not been infected."))
+            return
+
+        embed = utils.discord.create_embed(
+            author=ctx.author,
+            title=_(ctx, "Transmission chain of {member}").format(
+                member=member.display_name
+            ),
+        )
+        # Long chains would not fit into the embed field
+        chain = chain[::-1]
+        if len(chain) > 8:
+            chain = chain[:2] + [None] + chain[-5:]
+        embed.add_field(
+            name=_(ctx, "Chain"),
+            value=" → ".join(
+                self._user_name(user_id) if user_id else "…" for user_id in chain
+            ),
+            inline=False,
+        )
+        embed.add_field(name=_(ctx, "Depth"), value=stats.depth[member.id], inline=True)
+        embed.add_field(
+            name=_(ctx, "Infected directly"),
+            value=stats.offspring.get(member.id, 0),
+            inline=True,
+        )
+        embed.add_field(
+            name=_(ctx, "Infected in total"),
+            value=stats.descendants.get(member.id, 0),
+            inline=True,
+        )
+        await ctx.reply(embed=embed)
+
+    @check.acl2(check.ACLevel.MOD)
+    @infection_.command(name="stats")
+    async def infection_stats(self, ctx):
+        """Show statistics of the infection spread."""
+        stats: Optional[GuildStats] = self.stats.get(ctx.guild.id)
+        if not stats:
             await ctx.reply(_(ctx, "No one has been infected."))
             return
 
-        zero: datetime.datetime = everyone[0].infected_at
-        infected: Dict[int, int] = {}
+        embed = utils.discord.create_embed(
+            author=ctx.author,
+            title=_(ctx, "Infection statistics"),
+        )
+        embed.add_field(name=_(ctx, "Infected"), value=len(stats), inline=True)
+        embed.add_field(
+            name=_(ctx, "Longest chain"), value=stats.max_depth, inline=True
+        )
+        embed.add_field(
+            name=_(ctx, "Average depth"), value=f"{stats.mean_depth:.2f}", inline=True
+        )
+        spreaders: List[str] = [
+            f"{self._user_name(user_id)}: {direct} ({total})"
+            for user_id, direct, total in stats.top_spreaders()
+        ]
+        embed.add_field(
+            name=_(ctx, "Top spreaders (directly, in total)"),
+            value="\n".join(spreaders) or "-",
+            inline=False,
+        )
+        reproduction: List[str] = [
+            f"{utils.time.format_datetime(r.start)}: "
+            f"**{r.value:.2f}** ({r.infected})"
+            for r in stats.reproduction()
+        ]
+        embed.add_field(
+            name=_(ctx, "Reproduction number per hour (infected)"),
+            value="\n".join(reproduction) or "-",
+            inline=False,
+        )
+        channels: List[str] = [
+            _(ctx, "{channel}: {count} ({rate:.1f} per hour)").format(
+                channel=f"<#{c.channel_id}>", count=c.count, rate=c.rate
+            )
+            for c in stats.top_channels()
+        ]
+        embed.add_field(
+            name=_(ctx, "Channels"),
+            value="\n".join(channels) or "-",
+            inline=False,
+        )
+        await ctx.reply(embed=embed)
 
-        async with ctx.typing():
-            count: int = 0
-            minute: int = 0
-            while count < len(everyone):
-                since_zero = zero + datetime.timedelta(minutes=minute)
-                count = len([e for e in everyone if e.infected_at <= since_zero])
-                infected[minute] = count
-                minute += 5
+    def _user_name(self, user_id: int) -> str:
+        user = self.bot.get_user(user_id)
+        return getattr(user, "name", str(user_id))
 
-            chart = pygal.Line(show_legend=False)
+    @check.acl2(check.ACLevel.MOD)
+    @infection_.command(name="export")
+    async def infection_export(self, ctx, fmt: str = "jsonl"):
+        """Export infection data of the server.
+
+        fmt: jsonl or csv.
+        """
+        fmt = fmt.lower()
+        if fmt not in archive.FORMATS:
+            await ctx.reply(_(ctx, "Format has to be one of: jsonl, csv."))
+            return
 
-            chart.title = _(ctx, "Infection spread")
-            chart.width = 1200
-            chart.height = 600
+        await self.flush_infections()
+        files: List[nextcord.File] = []
+        config = await AsyncInfectionConfig.get(ctx.guild.id)
+        if config:
+            files.append(
+                nextcord.File(
+                    fp=io.BytesIO(archive.export_config(config)),
+                    filename="infection_config.json",
+                )
+            )
 
-            chart.x_labels = infected.keys()
-            chart.x_title = _(ctx, "Minutes since patient zero")
-            chart.y_title = _(ctx, "# of infected")
-            chart.interpolate = "cubic"
-            chart._min = 0
-            chart.add(_(ctx, "Infected"), infected.values())
+        # The rows are compressed into a file, not into memory
+        with tempfile.TemporaryFile() as handle:
+            async with ctx.typing():
+                count: int = await run_in_db(
+                    archive.export_data, ctx.guild.id, handle, fmt
+                )
+            if handle.tell() > ctx.guild.filesize_limit:
+                await ctx.reply(_(ctx, "The export is too large to be sent."))
+                return
+            handle.seek(0)
+            files.append(nextcord.File(fp=handle, filename=f"infection_data.{fmt}.gz"))
+            await ctx.reply(
+                _(ctx, "Exported {count} infections.").format(count=count),
+                files=files,
+                mention_author=False,
+            )
 
-            f = io.BytesIO()
-            chart.render_to_png(f)
-            f.seek(0)
+    @check.acl2(check.ACLevel.MOD)
+    @infection_.command(name="import")
+    async def infection_import(self, ctx):
+        """Import infection data from attached files.
+
+        Attach the files made by the export command. Members that already
+        have a record are skipped, so the import can be repeated.
+        """
+        config = config_cache.get(ctx.guild.id)
+        if not config:
+            await ctx.reply(_(ctx, "Config not initiated."))
+            return
+        if not ctx.message.attachments:
+            await ctx.reply(_(ctx, "Attach the exported files to the message."))
+            return
 
+        await self.flush_infections()
+        read: int = 0
+        inserted: int = 0
+        try:
+            async with ctx.typing():
+                for attachment in ctx.message.attachments:
+                    try:
+                        if attachment.filename.endswith(".json"):
+                            data: bytes = await attachment.read()
+                            changes: Dict = archive.read_config(data, config)
+                            await AsyncInfectionConfig.set(ctx.guild.id, **changes)
+                            config = config_cache.get(ctx.guild.id) or config
+                            continue
+                        with tempfile.TemporaryFile() as handle:
+                            await attachment.save(handle)
+                            handle.seek(0)
+                            file_read, file_inserted = await run_in_db(
+                                archive.import_data, ctx.guild.id, handle
+                            )
+                        read += file_read
+                        inserted += file_inserted
+                    except archive.ERRORS as exc:
+                        await ctx.reply(
+                            _(ctx, "The file {name} could not be imported.").format(
+                                name=attachment.filename
+                            )
+                        )
+                        await guild_log.error(
+                            ctx.author,
+                            ctx.channel,
+                            f"Could not import infection file {attachment.filename}.",
+                            exception=exc,
+                        )
+                        break
+        finally:
+            # Earlier chunks are committed even if a later one fails,
+            # reload everything that has been written behind the cog's back
+            self.update_activation()
+            await self.rebuild_index(ctx.guild.id)
+            await self.schedule_guild(ctx.guild.id)
         await ctx.reply(
-            file=nextcord.File(fp=f, filename="Infection statistics.png"),
-            mention_author=False,
+            _(ctx, "Imported {inserted} of {read} infections.").format(
+                inserted=inserted, read=read
+            )
         )
-        f.close()
+        await guild_log.info(
+            ctx.author,
+            ctx.channel,
+            f"Imported {inserted} of {read} infections.",
+        )
+
+    @check.acl2(check.ACLevel.BOT_OWNER)
+    @infection_.command(name="metrics")
+    async def infection_metrics(self, ctx):
+        """Show performance metrics of the infection module."""
+        with io.BytesIO(metrics.expose().encode("utf-8")) as f:
+            await ctx.reply(
+                file=nextcord.File(fp=f, filename="infection_metrics.txt"),
+                mention_author=False,
+            )
+
+    @check.acl2(check.ACLevel.BOT_OWNER)
+    @infection_.command(name="trace")
+    async def infection_trace(self, ctx, enabled: bool):
+        """Pass trace messages of the module to pie, or drop them."""
+        _trace.enabled = enabled
+        if enabled:
+            await ctx.reply(_(ctx, "Trace messages are passed to the bot."))
+        else:
+            await ctx.reply(_(ctx, "Trace messages are dropped."))
 
     @check.acl2(check.ACLevel.MOD)
     @infection_.command(name="infect")
     async def infection_infect(self, ctx, member: nextcord.Member):
         """Infect a member."""
-        infected = Infected.add(
+        if self.index.is_known(ctx.guild.id, member.id):
+            await ctx.reply(_(ctx, "That member cannot be infected."))
+            return
+        infected = await AsyncInfected.add(
             member.id,
             guild_id=ctx.guild.id,
             channel_id=ctx.channel.id,
             message_id=ctx.message.id,
             infected_by=0,
+            infected_at=ctx.message.created_at,
         )
         if not infected:
             await ctx.reply(_(ctx, "That member cannot be infected."))
             return
+        self.register_infection(
+            ctx.guild.id,
+            member.id,
+            infected_by=0,
+            channel_id=ctx.channel.id,
+            infected_at=infected.infected_at,
+        )
 
         await ctx.reply(_(ctx, "Member infected."))
         await guild_log.info(
@@ -288,12 +888,13 @@ class Infection(commands.Cog):
     @infection_config_.command(name="init")
     async def infection_config_init(self, ctx, role: nextcord.Role):
         """Initiate the infections."""
-        config = InfectionConfig.add(guild_id=ctx.guild.id, role_id=role.id)
+        config = await AsyncInfectionConfig.add(guild_id=ctx.guild.id, role_id=role.id)
         if not config:
             await ctx.reply(_(ctx, "Config is already initiated."))
             return
 
-        self.guilds = InfectionConfig.get_guild_ids()
+        await self.schedule_guild(ctx.guild.id)
+        self.update_activation()
         await ctx.reply(_(ctx, "Infection configuration has been initiated."))
         await guild_log.info(
             ctx.author.id,
@@ -305,15 +906,15 @@ class Infection(commands.Cog):
     @infection_config_.command(name="enable")
     async def infection_config_enable(self, ctx):
         """Enable the spread of infection."""
-        config = InfectionConfig.get(ctx.guild.id)
+        config = config_cache.get(ctx.guild.id)
         if not config:
             await ctx.reply(_(ctx, "Config is already initiated."))
             return
         if config.enabled:
             await ctx.reply(_(ctx, "The virus is already spreadng."))
             return
-        config.enabled = True
-        config.save()
+        await AsyncInfectionConfig.set(ctx.guild.id, enabled=True)
+        self.update_activation()
 
         await ctx.reply(_(ctx, "The virus will be spreadng now."))
         await guild_log.info(
@@ -326,15 +927,15 @@ class Infection(commands.Cog):
     @infection_config_.command(name="disable")
     async def infection_config_disable(self, ctx):
         """Disable the spread of infection."""
-        config = InfectionConfig.get(ctx.guild.id)
+        config = config_cache.get(ctx.guild.id)
         if not config:
             await ctx.reply(_(ctx, "Config is already initiated."))
             return
         if not config.enabled:
             await ctx.reply(_(ctx, "The virus is not spreadng."))
             return
-        config.enabled = False
-        config.save()
+        await AsyncInfectionConfig.set(ctx.guild.id, enabled=False)
+        self.update_activation()
 
         await ctx.reply(_(ctx, "The virus will not be spreadng now."))
         await guild_log.info(
@@ -347,15 +948,14 @@ class Infection(commands.Cog):
     @infection_config_.command(name="quiet")
     async def infection_config_quiet(self, ctx):
         """Make the infection spread quiet by not assigning roles."""
-        config = InfectionConfig.get(ctx.guild.id)
+        config = config_cache.get(ctx.guild.id)
         if not config:
             await ctx.reply(_(ctx, "Config is already initiated."))
             return
         if config.quiet:
             await ctx.reply(_(ctx, "The spreading is already quiet."))
             return
-        config.quiet = True
-        config.save()
+        await AsyncInfectionConfig.set(ctx.guild.id, quiet=True)
 
         await ctx.reply(_(ctx, "The virus will be spreadng quietly now."))
         await guild_log.info(
@@ -368,15 +968,14 @@ class Infection(commands.Cog):
     @infection_config_.command(name="verbose")
     async def infection_config_verbose(self, ctx):
         """Make the infection spread verbose by assigning roles."""
-        config = InfectionConfig.get(ctx.guild.id)
+        config = config_cache.get(ctx.guild.id)
         if not config:
             await ctx.reply(_(ctx, "Config is already initiated."))
             return
         if config.quiet:
             await ctx.reply(_(ctx, "The spreading is not quiet."))
             return
-        config.quiet = False
-        config.save()
+        await AsyncInfectionConfig.set(ctx.guild.id, quiet=False)
 
         await ctx.reply(_(ctx, "The virus will be spreadng visibly now."))
         await guild_log.info(
@@ -389,7 +988,7 @@ class Infection(commands.Cog):
     @infection_config_.command(name="get")
     async def infection_config_get(self, ctx):
         """Display infection configuration."""
-        config = InfectionConfig.get(ctx.guild.id)
+        config = await AsyncInfectionConfig.get(ctx.guild.id)
         if not config:
             await ctx.reply(_(ctx, "Config not initiated."))
             return
@@ -429,13 +1028,49 @@ class Infection(commands.Cog):
             value=_(ctx, "Yes") if config.enabled else _(ctx, "No"),
             inline=False,
         )
+        if config.starts_at or config.ends_at:
+            embed.add_field(
+                name=_(ctx, "Schedule"),
+                value="{} – {}".format(
+                    (
+                        utils.time.format_datetime(config.starts_at)
+                        if config.starts_at
+                        else "-"
+                    ),
+                    (
+                        utils.time.format_datetime(config.ends_at)
+                        if config.ends_at
+                        else "-"
+                    ),
+                ),
+                inline=False,
+            )
         await ctx.reply(embed=embed)
 
+    @check.acl2(check.ACLevel.MOD)
+    @infection_config_.command(name="reload")
+    async def infection_config_reload(self, ctx):
+        """Reload infection states from the database."""
+        config = await AsyncInfectionConfig.get(ctx.guild.id)
+        if config:
+            config_cache.update(config)
+        else:
+            config_cache.invalidate(ctx.guild.id)
+        self.update_activation()
+        await self.rebuild_index(ctx.guild.id)
+        await self.schedule_guild(ctx.guild.id)
+        await ctx.reply(_(ctx, "Infection states have been reloaded."))
+        await guild_log.info(
+            ctx.author,
+            ctx.channel,
+            "Infection states reloaded from the database.",
+        )
+
     @check.acl2(check.ACLevel.MOD)
     @infection_config_.command(name="probability")
     async def infection_config_probability(self, ctx, probability: float):
         """Set infection probability from interval <0, 1>."""
-        config = InfectionConfig.get(ctx.guild.id)
+        config = config_cache.get(ctx.guild.id)
         if not config:
             await ctx.reply(_(ctx, "Config not initiated."))
             return
@@ -444,8 +1079,8 @@ class Infection(commands.Cog):
             await ctx.reply(_(ctx, "Probability has to be in interval **<0, 1>**."))
             return
 
-        config.probability = probability
-        config.save()
+        await AsyncInfectionConfig.set(ctx.guild.id, probability=probability)
+        await self.schedule_guild(ctx.guild.id)
         await ctx.reply(
             _(ctx, "Infection probability set to {probability}.").format(
                 probability=probability
@@ -458,61 +1093,165 @@ class Infection(commands.Cog):
             f"Infection spreading probability set to {probability}.",
         )
 
+    @check.acl2(check.ACLevel.MOD)
+    @infection_config_.command(name="schedule")
+    async def infection_config_schedule(self, ctx, start: str, end: str):
+        """Set when the infection spreads.
+
+        start: Time in UTC, e.g. 2022-04-01T08:00, or - for no start.
+        end: Time in UTC, or - for no end.
+        """
+        config = config_cache.get(ctx.guild.id)
+        if not config:
+            await ctx.reply(_(ctx, "Config not initiated."))
+            return
+
+        try:
+            starts_at = self._parse_time(start)
+            ends_at = self._parse_time(end)
+        except ValueError:
+            await ctx.reply(
+                _(ctx, "Times have to be in format YYYY-MM-DDTHH:MM (UTC) or -.")
+            )
+            return
+        if starts_at and ends_at and ends_at <= starts_at:
+            await ctx.reply(_(ctx, "Invalid time range."))
+            return
+
+        await AsyncInfectionConfig.set(
+            ctx.guild.id, starts_at=starts_at, ends_at=ends_at
+        )
+        self.update_activation()
+        await ctx.reply(
+            _(ctx, "The infection will spread from {start} to {end}.").format(
+                start=utils.time.format_datetime(starts_at) if starts_at else "-",
+                end=utils.time.format_datetime(ends_at) if ends_at else "-",
+            )
+        )
+        await guild_log.info(
+            ctx.author,
+            ctx.channel,
+            f"Infection scheduled from {starts_at} to {ends_at}.",
+        )
+
+    @staticmethod
+    def _parse_time(value: str) -> Optional[datetime.datetime]:
+        if value == "-":
+            return None
+        result = datetime.datetime.fromisoformat(value)
+        if result.tzinfo is None:
+            result = result.replace(tzinfo=datetime.timezone.utc)
+        return result
+
     #
 
-    @commands.Cog.listener()
+    # Registered by update_activation() while an event is active
     async def on_message(self, message: nextcord.Message):
         if message.guild is None:
             return
+        start: int = time.perf_counter_ns()
+        result: str = await self._spread(message)
+        metrics.messages[result].inc()
+        metrics.message_latency.observe(time.perf_counter_ns() - start)
+
+    async def _spread(self, message: nextcord.Message) -> str:
+        """Try to pass the infection from the previous author.
+
+        :return: Label describing where the handler ended.
+        """
         if message.author.bot:
-            return
+            return "bot"
         if message.guild.id not in self.guilds:
-            _trace(f"Guild {message.guild} not registered.")
-            return
-        config = InfectionConfig.get(message.guild.id)
-        if not config or not config.enabled:
-            _trace(f"Spreading is disabled in guild {message.guild}.")
-            return
+            _trace.guild(message.guild, "Guild {} not registered.", message.guild)
+            return "unregistered"
+        config = config_cache.get(message.guild.id)
+        if not config or not config.is_active(message.created_at):
+            # Keep following the channels, the event may start at any time
+            self.message_cache.set(message.channel.id, message.author.id, message.id)
+            _trace.guild(
+                message.guild, "Spreading is disabled in guild {}.", message.guild
+            )
+            return "disabled"
 
-        previous_message = self.message_cache.get(message.channel, None)
-        if not previous_message:
-            _trace("Fetching previous message.")
-            previous_messages = await message.channel.history(
-                limit=1, before=message
-            ).flatten()
-            if previous_messages:
-                previous_message = previous_messages[0]
-            else:
-                previous_message = None
+        previous_message: Optional[LastMessage] = self.message_cache.get(
+            message.channel.id
+        )
+        if previous_message is not None:
+            metrics.message_cache["hit"].inc()
+        else:
+            metrics.message_cache["miss"].inc()
+            previous_message = await self.message_cache.fetch(
+                message.channel.id, lambda: self._fetch_previous_message(message)
+            )
+        self.message_cache.set(message.channel.id, message.author.id, message.id)
 
         if not previous_message:
-            _trace(f"No previous message before {message.id} in {message.channel}.")
-            return
-
-        self.message_cache[message.channel] = message
+            _trace.guild(
+                message.guild,
+                "No previous message before {} in {}.",
+                message.id,
+                message.channel,
+            )
+            return "no_previous"
 
-        if Infected.is_infected(message.guild.id, message.author.id):
-            _trace(f"{message.author} is already infected.")
-            return
+        if self.index.is_infected(message.guild.id, message.author.id):
+            _trace.guild(message.guild, "{} is already infected.", message.author)
+            return "infected"
 
-        if not Infected.is_infected(message.guild.id, previous_message.author.id):
-            _trace(f"Previous author {previous_message.author} not infected.")
-            return
+        if not self.index.is_infected(message.guild.id, previous_message.author_id):
+            _trace.guild(
+                message.guild,
+                "Previous author {} not infected.",
+                previous_message.author_id,
+            )
+            return "previous_healthy"
 
         roll: float = random.randint(0, 100) / 100
         probability: float = config.probability
         if roll > config.probability:
-            _trace(f"Rolled {roll}, needed {probability} or less.")
-            return
-
-        _trace(f"Infecting {message.author}: rolled {roll} < {probability}.")
-        Infected.add(
+            _trace.guild(
+                message.guild, "Rolled {}, needed {} or less.", roll, probability
+            )
+            return "roll_failed"
+
+        if self.index.is_known(message.guild.id, message.author.id):
+            _trace.guild(message.guild, "{} has already been cured.", message.author)
+            return "cured"
+
+        _trace("Infecting {}: rolled {} < {}.", message.author, roll, probability)
+        self.pending.append(
+            {
+                "user_id": message.author.id,
+                "guild_id": message.guild.id,
+                "channel_id": message.channel.id,
+                "message_id": message.id,
+                "infected_by": previous_message.author_id,
+                "infected_at": message.created_at,
+            }
+        )
+        self.register_infection(
+            message.guild.id,
             message.author.id,
-            guild_id=message.guild.id,
+            infected_by=previous_message.author_id,
             channel_id=message.channel.id,
-            message_id=message.id,
-            infected_by=previous_message.author.id,
+            infected_at=message.created_at,
         )
+        if len(self.pending) >= 100:
+            await self.flush_infections()
+        return "infection"
+
+    async def _fetch_previous_message(
+        self, message: nextcord.Message
+    ) -> Optional[LastMessage]:
+        _trace("Fetching previous message.")
+        previous_messages = await message.channel.history(
+            limit=1, before=message
+        ).flatten()
+        if not previous_messages:
+            metrics.history_fetches["empty"].inc()
+            return None
+        metrics.history_fetches["found"].inc()
+        return LastMessage(previous_messages[0].author.id, previous_messages[0].id)
 
 
 def setup(bot) -> None:
@@ -0,0 +1,176 @@
+import asyncio
+import random
+import time
+from typing import Dict, List, Optional, Tuple
+
+import nextcord
+
+from pie import logger
+
+from .metrics import metrics
+
+bot_log = logger.Bot.logger()
+guild_log = logger.Guild.logger()
+
+
+class RoleQueue:
+    """Queue of role changes handled by a bounded pool of workers.
+
+    Requests are coalesced per member: repeated requests are merged and an
+    addition followed by a removal of the same role (or the other way around)
+    results in the last requested state only. Role endpoints share a rate
+    limit bucket per guild, so a 429 response pauses all workers working on
+    that guild until the bucket resets.
+    """
+
+    def __init__(
+        self,
+        bot,
+        *,
+        workers: int = 4,
+        retries: int = 5,
+        backoff: float = 1.0,
+    ):
+        self.bot = bot
+        self.workers: int = workers
+        self.retries: int = retries
+        self.backoff: float = backoff
+
+        # (guild ID, user ID) -> {role ID: should the member have it}
+        self._pending: Dict[Tuple[int, int], Dict[int, bool]] = {}
+        self._queue: asyncio.Queue = asyncio.Queue()
+        # guild ID -> monotonic time when the rate limit bucket resets
+        self._buckets: Dict[int, float] = {}
+        self._tasks: List[asyncio.Task] = []
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def start(self):
+        for _ in range(self.workers - len(self._tasks)):
+            self._tasks.append(self.bot.loop.create_task(self._worker()))
+
+    def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    def add(self, guild_id: int, user_id: int, role_id: int):
+        self._request(guild_id, user_id, role_id, True)
+
+    def remove(self, guild_id: int, user_id: int, role_id: int):
+        self._request(guild_id, user_id, role_id, False)
+
+    def _request(self, guild_id: int, user_id: int, role_id: int, present: bool):
+        key = (guild_id, user_id)
+        if key not in self._pending:
+            self._pending[key] = {}
+            self._queue.put_nowait(key)
+        self._pending[key][role_id] = present
+
+    async def _worker(self):
+        while True:
+            key = await self._queue.get()
+            changes: Dict[int, bool] = self._pending.pop(key, {})
+            try:
+                await self._apply(*key, changes)
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                await bot_log.error(
+                    None,
+                    None,
+                    f"Could not update infection roles of user {key[1]} "
+                    f"in guild {key[0]}.",
+                    exception=exc,
+                )
+            finally:
+                self._queue.task_done()
+
+    async def _apply(self, guild_id: int, user_id: int, changes: Dict[int, bool]):
+        guild: Optional[nextcord.Guild] = self.bot.get_guild(guild_id)
+        if not guild:
+            return
+        member: Optional[nextcord.Member] = guild.get_member(user_id)
+        if not member:
+            await guild_log.debug(
+                self.bot.user,
+                guild.text_channels[0],
+                f"Could not find user {user_id}.",
+            )
+            return
+
+        for role_id, present in changes.items():
+            role: Optional[nextcord.Role] = guild.get_role(role_id)
+            if not role:
+                await guild_log.error(
+                    self.bot.user,
+                    guild.text_channels[0],
+                    f"Could not find role {role_id}.",
+                )
+                continue
+            # Skip requests that would not change anything
+            if present == (role in member.roles):
+                continue
+
+            try:
+                if present:
+                    await self._call(guild_id, member.add_roles, role, "Infection")
+                    await guild_log.info(
+                        self.bot.user,
+                        guild.text_channels[0],
+                        f"Adding infected role to {member}.",
+                    )
+                else:
+                    await self._call(guild_id, member.remove_roles, role, "Cured")
+                    await guild_log.info(
+                        self.bot.user,
+                        guild.text_channels[0],
+                        f"Removing infected role from {member}@{guild.name}.",
+                    )
+            except nextcord.Forbidden:
+                action: str = "add role to" if present else "remove role from"
+                await guild_log.debug(
+                    self.bot.user,
+                    guild.text_channels[0],
+                    f"Cannot {action} {member}: permission denied.",
+                )
+            except nextcord.NotFound:
+                continue
+
+    async def _call(self, guild_id: int, func, role: nextcord.Role, reason: str):
+        """Call the API, waiting for rate limits and retrying transient errors."""
+        for attempt in range(self.retries + 1):
+            delay: float = self._buckets.get(guild_id, 0.0) - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            try:
+                result = await func(role, reason=reason)
+                metrics.role_calls["ok"].inc()
+                return result
+            except (nextcord.Forbidden, nextcord.NotFound):
+                metrics.role_calls["error"].inc()
+                raise
+            except nextcord.HTTPException as exc:
+                metrics.role_calls[
+                    "rate_limited" if exc.status == 429 else "error"
+                ].inc()
+                if attempt == self.retries:
+                    raise
+                if exc.status == 429:
+                    retry_after = exc.response.headers.get("Retry-After", None)
+                    delay = float(retry_after) if retry_after else self.backoff
+                    self._buckets[guild_id] = time.monotonic() + delay
+                    continue
+                if exc.status < 500:
+                    raise
+                await asyncio.sleep(self._backoff(attempt))
+            except (asyncio.TimeoutError, OSError):
+                metrics.role_calls["error"].inc()
+                if attempt == self.retries:
+                    raise
+                await asyncio.sleep(self._backoff(attempt))
+
+    def _backoff(self, attempt: int) -> float:
+        return self.backoff * 2**attempt * random.uniform(1.0, 1.5)
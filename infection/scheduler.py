@@ -0,0 +1,133 @@
+import asyncio
+import datetime
+import enum
+import heapq
+from typing import Dict, Iterable, List, NamedTuple, Tuple
+
+
+class Transition(enum.IntEnum):
+    SYMPTOMS = 0
+    CURE = 1
+
+
+class Due(NamedTuple):
+    guild_id: int
+    user_id: int
+    transition: Transition
+
+
+def utcnow() -> datetime.datetime:
+    return datetime.datetime.utcnow().replace(tzinfo=datetime.timezone.utc)
+
+
+class TransitionScheduler:
+    """Priority queue of symptom and cure deadlines.
+
+    Entries are ordered by the time of the transition. Rescheduling a guild
+    bumps its generation, which turns its older entries into tombstones
+    that are dropped once they reach the top of the heap.
+    """
+
+    def __init__(self):
+        self._heap: List[Tuple[datetime.datetime, int, int, int, Transition]] = []
+        self._generations: Dict[int, int] = {}
+        self._changed = asyncio.Event()
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def _push(
+        self,
+        deadline: datetime.datetime,
+        guild_id: int,
+        user_id: int,
+        transition: Transition,
+    ):
+        generation: int = self._generations.get(guild_id, 0)
+        entry = (deadline, guild_id, generation, user_id, transition)
+        wake: bool = not self._heap or deadline < self._heap[0][0]
+        heapq.heappush(self._heap, entry)
+        if wake:
+            self._changed.set()
+
+    def schedule(
+        self,
+        guild_id: int,
+        user_id: int,
+        infected_at: datetime.datetime,
+        *,
+        symptom_delay: datetime.timedelta,
+        cure_delay: datetime.timedelta,
+        symptomatic: bool = False,
+    ):
+        """Schedule transitions of one infected member."""
+        if not symptomatic:
+            self._push(
+                infected_at + symptom_delay, guild_id, user_id, Transition.SYMPTOMS
+            )
+        self._push(infected_at + cure_delay, guild_id, user_id, Transition.CURE)
+
+    def reschedule(
+        self,
+        guild_id: int,
+        spreaders: Iterable[Tuple[int, datetime.datetime, bool]],
+        *,
+        symptom_delay: datetime.timedelta,
+        cure_delay: datetime.timedelta,
+    ):
+        """Replace all transitions of a guild.
+
+        :param spreaders: Iterable of ``(user_id, infected_at, symptomatic)``
+            of members that are not cured yet.
+        """
+        self._generations[guild_id] = self._generations.get(guild_id, 0) + 1
+        for user_id, infected_at, symptomatic in spreaders:
+            self.schedule(
+                guild_id,
+                user_id,
+                infected_at,
+                symptom_delay=symptom_delay,
+                cure_delay=cure_delay,
+                symptomatic=symptomatic,
+            )
+        # Earlier deadlines may have been removed as well
+        self._changed.set()
+
+    def _drop_stale(self):
+        while self._heap:
+            _, guild_id, generation, _, _ = self._heap[0]
+            if generation == self._generations.get(guild_id, 0):
+                return
+            heapq.heappop(self._heap)
+
+    def pop_due(self, now: datetime.datetime) -> List[Due]:
+        """Remove and return all transitions with deadline before ``now``."""
+        due: List[Due] = []
+        self._drop_stale()
+        while self._heap and self._heap[0][0] <= now:
+            _, guild_id, _, user_id, transition = heapq.heappop(self._heap)
+            due.append(Due(guild_id, user_id, transition))
+            self._drop_stale()
+        return due
+
+    async def wait(self) -> List[Due]:
+        """Sleep until the earliest deadline and return the due transitions.
+
+        Deadlines that have already passed (e.g. while the bot was offline)
+        are returned immediately.
+        """
+        while True:
+            self._changed.clear()
+            due = self.pop_due(utcnow())
+            if due:
+                return due
+
+            if not self._heap:
+                await self._changed.wait()
+                continue
+
+            timeout: float = (self._heap[0][0] - utcnow()).total_seconds()
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
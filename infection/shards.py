@@ -0,0 +1,49 @@
+from typing import FrozenSet, Iterable, Optional
+
+
+class ShardSet:
+    """Shards handled by this process.
+
+    Discord assigns a guild to the shard ``(guild_id >> 22) % shard_count``.
+    When the bot is split into several processes, each of them only receives
+    events of the guilds on its own shards, so it must only load and process
+    those guilds. Without sharding (or when the shard IDs are not known yet,
+    because a single process runs all of them), every guild is local.
+
+    :param shard_count: Total number of shards.
+    :param shard_ids: Shards running in this process.
+    """
+
+    def __init__(
+        self,
+        shard_count: Optional[int] = None,
+        shard_ids: Optional[Iterable[int]] = None,
+    ):
+        self.shard_count: int = shard_count or 1
+        self.shard_ids: Optional[FrozenSet[int]] = None
+        if shard_ids is not None and self.shard_count > 1:
+            self.shard_ids = frozenset(shard_ids)
+            if self.shard_ids >= set(range(self.shard_count)):
+                self.shard_ids = None
+
+    @classmethod
+    def from_bot(cls, bot) -> "ShardSet":
+        shard_ids: Optional[Iterable[int]] = getattr(bot, "shard_ids", None)
+        if shard_ids is None and getattr(bot, "shard_id", None) is not None:
+            shard_ids = (bot.shard_id,)
+        return cls(bot.shard_count, shard_ids)
+
+    @property
+    def everything(self) -> bool:
+        """Whether all guilds are handled by this process."""
+        return self.shard_ids is None
+
+    def shard_of(self, guild_id: int) -> int:
+        return (guild_id >> 22) % self.shard_count
+
+    def owns(self, guild_id: int) -> bool:
+        return self.shard_ids is None or self.shard_of(guild_id) in self.shard_ids
+
+    def __repr__(self) -> str:
+        shards = "all" if self.shard_ids is None else sorted(self.shard_ids)
+        return f"<ShardSet shard_count={self.shard_count} shard_ids={shards}>"
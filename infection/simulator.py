@@ -0,0 +1,543 @@
+"""Offline simulator of the infection spread.
+
+The simulator feeds a message stream through the real :class:`Infection`
+cog, using stand-ins for the bot, guilds, channels and members and a
+temporary SQLite database. It does not connect to Discord.
+
+Run it from the root of the bot::
+
+    python -m modules.events.infection.simulator spread --help
+    python -m modules.events.infection.simulator bench --help
+
+``spread`` replays a synthetic (or recorded) stream in compressed time,
+so the symptom and cure transitions are applied by the real infection
+loop, and prints the number of infected members over time.
+
+``bench`` sends messages to ``on_message`` as fast as possible and prints
+throughput and handler latency for different guild sizes.
+
+``cycle`` seeds guilds with many infected members, a part of them due for
+symptoms or cure, and times one transition cycle: the bulk updates used by
+the module, and the old loop committing every spreader separately.
+"""
+
+import argparse
+import asyncio
+import datetime
+import itertools
+import json
+import os
+import random
+import statistics
+import tempfile
+import time
+from typing import Dict, Iterator, List, NamedTuple, Optional
+
+import nextcord
+
+
+class FakeUser:
+    def __init__(self, user_id: int, *, bot: bool = False):
+        self.id: int = user_id
+        self.bot: bool = bot
+        self.name: str = f"user{user_id}"
+
+    def __str__(self) -> str:
+        return self.name
+
+
+class FakeGuild:
+    def __init__(self, guild_id: int, members: List[FakeUser]):
+        self.id: int = guild_id
+        self.name: str = f"guild{guild_id}"
+        self.members: Dict[int, FakeUser] = {m.id: m for m in members}
+        self.member_count: int = len(members)
+
+    def get_member(self, user_id: int) -> Optional[FakeUser]:
+        return self.members.get(user_id, None)
+
+    def __str__(self) -> str:
+        return self.name
+
+
+class _EmptyHistory:
+    async def flatten(self) -> list:
+        return []
+
+
+class FakeChannel:
+    def __init__(self, channel_id: int, guild: FakeGuild):
+        self.id: int = channel_id
+        self.guild: FakeGuild = guild
+        self.name: str = f"channel{channel_id}"
+
+    def history(self, *, limit: int, before) -> _EmptyHistory:
+        # The simulated channels start empty
+        return _EmptyHistory()
+
+    def __str__(self) -> str:
+        return self.name
+
+
+class FakeMessage:
+    def __init__(
+        self,
+        message_id: int,
+        author: FakeUser,
+        channel: FakeChannel,
+        created_at: datetime.datetime,
+    ):
+        self.id: int = message_id
+        self.author: FakeUser = author
+        self.channel: FakeChannel = channel
+        self.guild: FakeGuild = channel.guild
+        self.created_at: datetime.datetime = created_at
+
+
+class FakeBot:
+    shard_count = None
+    shard_ids = None
+
+    def __init__(self):
+        self.loop = asyncio.get_running_loop()
+        self.user = FakeUser(1, bot=True)
+        self.cached_messages: List[FakeMessage] = []
+        self.guilds: Dict[int, FakeGuild] = {}
+        self.listeners: Dict[str, list] = {}
+
+    async def wait_until_ready(self):
+        return
+
+    def add_listener(self, func, name: str):
+        self.listeners.setdefault(name, []).append(func)
+
+    def remove_listener(self, func, name: str):
+        self.listeners[name].remove(func)
+
+    def get_guild(self, guild_id: int) -> Optional[FakeGuild]:
+        return self.guilds.get(guild_id, None)
+
+    def get_user(self, user_id: int) -> Optional[FakeUser]:
+        for guild in self.guilds.values():
+            if user_id in guild.members:
+                return guild.members[user_id]
+        return None
+
+
+class Post(NamedTuple):
+    """One message of the stream, ``time`` is in seconds from the start."""
+
+    time: float
+    channel: int
+    author: int
+
+
+def synthetic_stream(
+    *,
+    members: int,
+    channels: int,
+    per_hour: float,
+    hours: float,
+    rng: random.Random,
+) -> Iterator[Post]:
+    """Generate messages with Poisson arrivals and heavy-tailed activity.
+
+    A few members and channels get most of the messages, like on a real server.
+    """
+    member_weights = [rng.paretovariate(1.2) for _ in range(members)]
+    channel_weights = [rng.paretovariate(1.2) for _ in range(channels)]
+    rate: float = per_hour / 3600
+    now: float = rng.expovariate(rate)
+    while now < hours * 3600:
+        (author,) = rng.choices(range(members), weights=member_weights)
+        (channel,) = rng.choices(range(channels), weights=channel_weights)
+        yield Post(now, channel, author)
+        now += rng.expovariate(rate)
+
+
+def recorded_stream(path: str) -> List[Post]:
+    """Read messages from JSON lines with ``created_at``, ``channel_id``
+    and ``author_id`` keys."""
+    rows: List[dict] = []
+    with open(path) as handle:
+        for line in handle:
+            if line.strip():
+                rows.append(json.loads(line))
+    times = [datetime.datetime.fromisoformat(row["created_at"]) for row in rows]
+    start = min(times)
+    # Channels and members are numbered in order of appearance
+    channels: Dict[int, int] = {}
+    authors: Dict[int, int] = {}
+    return sorted(
+        Post(
+            (t - start).total_seconds(),
+            channels.setdefault(row["channel_id"], len(channels)),
+            authors.setdefault(row["author_id"], len(authors)),
+        )
+        for t, row in zip(times, rows)
+    )
+
+
+class Simulation:
+    """Infection cog running against a temporary database."""
+
+    def __init__(self, bot: FakeBot, cog):
+        self.bot: FakeBot = bot
+        self.cog = cog
+        self.guild_ids = itertools.count(1_000_000, 1_000_000)
+        self.message_ids = itertools.count(
+            nextcord.utils.time_snowflake(datetime.datetime.now(datetime.timezone.utc))
+        )
+
+    @classmethod
+    async def create(cls) -> "Simulation":
+        # The database has to be chosen before pie is imported
+        directory: str = tempfile.mkdtemp(prefix="infection-simulator-")
+        os.environ["DB_STRING"] = "sqlite:///" + os.path.join(directory, "db.sqlite")
+
+        from pie.database import database
+
+        from .module import Infection
+
+        database.base.metadata.create_all(database.db)
+        bot = FakeBot()
+        return cls(bot, Infection(bot))
+
+    async def add_guild(
+        self,
+        *,
+        members: int,
+        channels: int,
+        probability: float,
+        symptom_delay: datetime.timedelta,
+        cure_delay: datetime.timedelta,
+    ):
+        from .database import AsyncInfected, AsyncInfectionConfig
+
+        guild_id: int = next(self.guild_ids)
+        guild = FakeGuild(
+            guild_id, [FakeUser(guild_id + i + 1) for i in range(members)]
+        )
+        self.bot.guilds[guild_id] = guild
+        channel_list = [FakeChannel(guild_id + i + 1, guild) for i in range(channels)]
+
+        await AsyncInfectionConfig.add(guild_id=guild_id, role_id=guild_id)
+        await AsyncInfectionConfig.set(
+            guild_id,
+            probability=probability,
+            symptom_delay=symptom_delay,
+            cure_delay=cure_delay,
+            # There are no roles to assign
+            quiet=True,
+        )
+
+        patient_zero: FakeUser = next(iter(guild.members.values()))
+        now = datetime.datetime.now(datetime.timezone.utc)
+        message_id: int = next(self.message_ids)
+        await AsyncInfected.add(
+            patient_zero.id,
+            guild_id=guild_id,
+            channel_id=channel_list[0].id,
+            message_id=message_id,
+            infected_by=0,
+            infected_at=now,
+        )
+        self.cog.register_infection(
+            guild_id,
+            patient_zero.id,
+            infected_by=0,
+            channel_id=channel_list[0].id,
+            infected_at=now,
+        )
+        await self.cog.schedule_guild(guild_id)
+        self.cog.update_activation()
+        return guild, channel_list
+
+    async def seed(self, guild: FakeGuild, channel: FakeChannel, rows: int, *, span):
+        """Insert infected members, infected evenly over the last ``span``."""
+        from .database import AsyncInfected
+
+        now = datetime.datetime.now(datetime.timezone.utc)
+        patient_zero: int = next(iter(guild.members))
+        batch: List[Dict] = []
+        for i in range(rows):
+            batch.append(
+                {
+                    "user_id": guild.id + len(guild.members) + i + 1,
+                    "guild_id": guild.id,
+                    "channel_id": channel.id,
+                    "message_id": next(self.message_ids),
+                    "infected_by": patient_zero,
+                    "infected_at": now - span * (i + 1) / rows,
+                }
+            )
+            if len(batch) == 10_000:
+                await AsyncInfected.add_many(batch)
+                batch = []
+        await AsyncInfected.add_many(batch)
+        await self.cog.rebuild_index(guild.id)
+
+    def message(self, guild: FakeGuild, channel: FakeChannel, author_index: int):
+        author: FakeUser = guild.members[guild.id + author_index + 1]
+        return FakeMessage(
+            next(self.message_ids),
+            author,
+            channel,
+            datetime.datetime.now(datetime.timezone.utc),
+        )
+
+    def counts(self, guild_id: int) -> Dict[str, int]:
+        index = self.cog.index
+        infected: int = len(index.infected.get(guild_id, ()))
+        symptomatic: int = len(index.symptomatic.get(guild_id, ()))
+        return {
+            "asymptomatic": infected - symptomatic,
+            "symptomatic": symptomatic,
+            "cured": len(index.cured.get(guild_id, ())),
+        }
+
+    def close(self):
+        self.cog.cog_unload()
+
+
+async def run_spread(args: argparse.Namespace):
+    rng = random.Random(args.seed)
+    if args.replay:
+        posts: List[Post] = recorded_stream(args.replay)
+        members: int = max(p.author for p in posts) + 1
+        channels: int = max(p.channel for p in posts) + 1
+    else:
+        members, channels = args.members, args.channels
+        posts = list(
+            synthetic_stream(
+                members=members,
+                channels=channels,
+                per_hour=args.per_hour,
+                hours=args.hours,
+                rng=rng,
+            )
+        )
+    duration: float = max((p.time for p in posts), default=0.0)
+    speedup: float = args.speedup
+
+    # Delays are compressed together with the stream
+    simulation = await Simulation.create()
+    guild, channel_list = await simulation.add_guild(
+        members=members,
+        channels=channels,
+        probability=args.probability,
+        symptom_delay=datetime.timedelta(hours=args.symptom_delay / speedup),
+        cure_delay=datetime.timedelta(hours=args.cure_delay / speedup),
+    )
+    random.seed(args.seed)
+
+    step: float = args.step * 60
+    print(f"{len(posts)} messages, {members} members, {channels} channels")
+    print(f"{'hour':>6} {'asymptomatic':>13} {'symptomatic':>12} {'cured':>8}")
+
+    def report(hour: float):
+        counts = simulation.counts(guild.id)
+        print(
+            f"{hour:6.1f} {counts['asymptomatic']:13} "
+            f"{counts['symptomatic']:12} {counts['cured']:8}"
+        )
+
+    start: float = time.monotonic()
+    next_report: float = 0.0
+    try:
+        for post in itertools.chain(posts, [Post(duration + step, -1, -1)]):
+            while next_report <= post.time:
+                await asyncio.sleep(start + next_report / speedup - time.monotonic())
+                report(next_report / 3600)
+                next_report += step
+            if post.channel < 0:
+                break
+            await asyncio.sleep(start + post.time / speedup - time.monotonic())
+            await simulation.cog.on_message(
+                simulation.message(guild, channel_list[post.channel], post.author)
+            )
+    finally:
+        simulation.close()
+
+
+async def run_bench(args: argparse.Namespace):
+    from .metrics import metrics
+
+    simulation = await Simulation.create()
+    random.seed(args.seed)
+    rng = random.Random(args.seed)
+
+    print(
+        f"{'members':>8} {'messages':>9} {'msg/s':>9} {'p50 µs':>9} "
+        f"{'p99 µs':>9} {'infected':>9}"
+    )
+    try:
+        for size in args.sizes:
+            guild, channel_list = await simulation.add_guild(
+                members=size,
+                channels=args.channels,
+                probability=args.probability,
+                symptom_delay=datetime.timedelta(hours=args.symptom_delay),
+                cure_delay=datetime.timedelta(hours=args.cure_delay),
+            )
+            messages = [
+                simulation.message(
+                    guild,
+                    channel_list[rng.randrange(args.channels)],
+                    rng.randrange(size),
+                )
+                for _ in range(args.messages)
+            ]
+            latencies: List[int] = []
+            started: int = time.perf_counter_ns()
+            for message in messages:
+                before: int = time.perf_counter_ns()
+                await simulation.cog.on_message(message)
+                latencies.append(time.perf_counter_ns() - before)
+            elapsed: int = time.perf_counter_ns() - started
+
+            quantiles = statistics.quantiles(latencies, n=100)
+            infected: int = simulation.cog.index.count(guild.id)
+            print(
+                f"{size:8} {len(messages):9} {len(messages) / elapsed * 1e9:9.0f} "
+                f"{quantiles[49] / 1e3:9.1f} {quantiles[98] / 1e3:9.1f} "
+                f"{infected:9}"
+            )
+    finally:
+        simulation.close()
+
+    print()
+    for result, counter in metrics.messages.counters.items():
+        print(f"{result:>17} {counter.value}")
+
+
+def _per_row_cycle(guild_id: int, symptom_delay, cure_delay):
+    """Transition cycle of the old polling loop, committing every spreader."""
+    from .database import Infected
+
+    now = datetime.datetime.now(datetime.timezone.utc)
+    for spreader in Infected.get_spreaders(guild_id):
+        delta: datetime.timedelta = now - spreader.infected_at
+        if delta > symptom_delay and not spreader.cured:
+            spreader.symptomatic = True
+        if delta > cure_delay:
+            spreader.symptomatic = False
+            spreader.cured = True
+        spreader.save()
+
+
+async def run_cycle(args: argparse.Namespace):
+    simulation = await Simulation.create()
+
+    from .database import run_in_db
+
+    symptom_delay = datetime.timedelta(hours=args.symptom_delay)
+    cure_delay = datetime.timedelta(hours=args.cure_delay)
+
+    print(
+        f"{'infected':>9} {'symptoms':>9} {'cured':>9} "
+        f"{'per row ms':>11} {'bulk ms':>9}"
+    )
+    try:
+        for size in args.sizes:
+            # The same population twice, each cycle changes its guild
+            guilds = []
+            for _ in range(2):
+                guild, channel_list = await simulation.add_guild(
+                    members=1,
+                    channels=1,
+                    probability=args.probability,
+                    symptom_delay=symptom_delay,
+                    cure_delay=cure_delay,
+                )
+                await simulation.seed(
+                    guild, channel_list[0], size, span=cure_delay * args.span
+                )
+                guilds.append(guild)
+
+            started: int = time.perf_counter_ns()
+            await run_in_db(_per_row_cycle, guilds[0].id, symptom_delay, cure_delay)
+            per_row: int = time.perf_counter_ns() - started
+
+            started = time.perf_counter_ns()
+            await simulation.cog._recover(guilds[1].id)
+            bulk: int = time.perf_counter_ns() - started
+
+            counts = simulation.counts(guilds[1].id)
+            print(
+                f"{size:9} {counts['symptomatic']:9} {counts['cured']:9} "
+                f"{per_row / 1e6:11.1f} {bulk / 1e6:9.1f}"
+            )
+    finally:
+        simulation.close()
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(
+        prog="python -m modules.events.infection.simulator",
+        description="Simulate the infection spread without connecting to Discord.",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--probability", type=float, default=0.05)
+    parser.add_argument(
+        "--symptom-delay", type=float, default=3.0, help="hours (default: 3)"
+    )
+    parser.add_argument(
+        "--cure-delay", type=float, default=12.0, help="hours (default: 12)"
+    )
+    parser.add_argument("--channels", type=int, default=10)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    spread = subparsers.add_parser("spread", help="print the spread over time")
+    spread.add_argument("--members", type=int, default=500)
+    spread.add_argument("--per-hour", type=float, default=2000, help="messages")
+    spread.add_argument("--hours", type=float, default=24.0)
+    spread.add_argument(
+        "--speedup",
+        type=float,
+        default=3600.0,
+        help="simulated seconds per real second (default: 3600)",
+    )
+    spread.add_argument(
+        "--step", type=float, default=60.0, help="report interval in minutes"
+    )
+    spread.add_argument(
+        "--replay",
+        metavar="FILE",
+        help="JSON lines with created_at, channel_id and author_id",
+    )
+
+    bench = subparsers.add_parser("bench", help="measure on_message throughput")
+    bench.add_argument(
+        "--sizes",
+        type=lambda value: [int(v) for v in value.split(",")],
+        default=[100, 1000, 10000],
+        help="comma separated guild sizes (default: 100,1000,10000)",
+    )
+    bench.add_argument("--messages", type=int, default=20000)
+
+    cycle = subparsers.add_parser("cycle", help="measure one transition cycle")
+    cycle.add_argument(
+        "--sizes",
+        type=lambda value: [int(v) for v in value.split(",")],
+        default=[1000, 10000, 50000],
+        help="comma separated numbers of infected (default: 1000,10000,50000)",
+    )
+    cycle.add_argument(
+        "--span",
+        type=float,
+        default=1.5,
+        help="infections are spread over this many cure delays (default: 1.5)",
+    )
+
+    args = parser.parse_args(argv)
+    if args.command == "spread":
+        asyncio.run(run_spread(args))
+    elif args.command == "bench":
+        asyncio.run(run_bench(args))
+    else:
+        asyncio.run(run_cycle(args))
+
+
+if __name__ == "__main__":
+    main()
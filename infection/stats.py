@@ -0,0 +1,196 @@
+import datetime
+import heapq
+from typing import Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
+
+
+class ChannelSpread(NamedTuple):
+    channel_id: int
+    count: int
+    # Infections per hour between the first and the last one in the channel
+    rate: float
+
+
+class Reproduction(NamedTuple):
+    start: datetime.datetime
+    infected: int
+    # Mean number of members infected by those infected in this period
+    value: float
+
+
+class GuildStats:
+    """Transmission tree of one guild with aggregates kept up to date.
+
+    Every infection updates the aggregates in place: the depth is taken
+    from the infector, the subtree sizes of its ancestors are incremented
+    and the counters of the channel and of the infection periods are bumped.
+    Reading the statistics then never walks the whole tree.
+
+    :param period: Length of the periods of the reproduction number.
+    """
+
+    def __init__(self, period: datetime.timedelta):
+        self.period: int = int(period.total_seconds())
+        # user ID -> ID of the infector, 0 for patient zero
+        self.parent: Dict[int, int] = {}
+        self.depth: Dict[int, int] = {}
+        # depth -> number of members at that depth
+        self.depths: Dict[int, int] = {}
+        # user ID -> number of members infected by the user directly
+        self.offspring: Dict[int, int] = {}
+        # user ID -> number of members in the user's subtree
+        self.descendants: Dict[int, int] = {}
+        # channel ID -> [count, first infection, last infection]
+        self.channels: Dict[int, List] = {}
+        # user ID -> period of infection
+        self.cohort: Dict[int, int] = {}
+        # period -> [members infected in it, members they have infected]
+        self.cohorts: Dict[int, List[int]] = {}
+
+    def __len__(self) -> int:
+        return len(self.parent)
+
+    def add(
+        self,
+        user_id: int,
+        infected_by: int,
+        channel_id: int,
+        infected_at: datetime.datetime,
+    ) -> None:
+        if user_id in self.parent:
+            return
+
+        # The user is not in the tree yet, so a walk that ends with them
+        # means the row would close a cycle; such rows are counted as roots
+        ancestors: List[int] = []
+        seen: Set[int] = set()
+        ancestor: int = infected_by
+        while ancestor in self.parent and ancestor not in seen:
+            seen.add(ancestor)
+            ancestors.append(ancestor)
+            ancestor = self.parent[ancestor]
+        if ancestor == user_id:
+            infected_by = 0
+            ancestors = []
+        self.parent[user_id] = infected_by
+
+        # Infectors that are not known are counted as roots
+        depth: int = self.depth[infected_by] + 1 if infected_by in self.depth else 0
+        self.depth[user_id] = depth
+        self.depths[depth] = self.depths.get(depth, 0) + 1
+
+        if ancestors:
+            self.offspring[infected_by] = self.offspring.get(infected_by, 0) + 1
+            for ancestor in ancestors:
+                self.descendants[ancestor] = self.descendants.get(ancestor, 0) + 1
+
+        channel: Optional[List] = self.channels.get(channel_id, None)
+        if channel is None:
+            self.channels[channel_id] = [1, infected_at, infected_at]
+        else:
+            channel[0] += 1
+            channel[1] = min(channel[1], infected_at)
+            channel[2] = max(channel[2], infected_at)
+
+        period: int = int(infected_at.timestamp()) // self.period
+        self.cohort[user_id] = period
+        self.cohorts.setdefault(period, [0, 0])[0] += 1
+        if infected_by in self.cohort:
+            self.cohorts.setdefault(self.cohort[infected_by], [0, 0])[1] += 1
+
+    @property
+    def max_depth(self) -> int:
+        return max(self.depths, default=0)
+
+    @property
+    def mean_depth(self) -> float:
+        if not self.depth:
+            return 0.0
+        return sum(d * c for d, c in self.depths.items()) / len(self.depth)
+
+    def chain(self, user_id: int) -> List[int]:
+        """Get IDs of the user's infectors, starting with the user."""
+        chain: List[int] = []
+        while user_id in self.parent and user_id not in chain:
+            chain.append(user_id)
+            user_id = self.parent[user_id]
+        return chain
+
+    def top_spreaders(self, limit: int = 5) -> List[Tuple[int, int, int]]:
+        """Get (user_id, directly infected, subtree size) of top spreaders."""
+        users = heapq.nlargest(limit, self.offspring, key=self.offspring.__getitem__)
+        return [(u, self.offspring[u], self.descendants.get(u, 0)) for u in users]
+
+    def top_channels(self, limit: int = 5) -> List[ChannelSpread]:
+        items = heapq.nlargest(
+            limit, self.channels.items(), key=lambda item: item[1][0]
+        )
+        result: List[ChannelSpread] = []
+        for channel_id, (count, first, last) in items:
+            hours: float = (last - first).total_seconds() / 3600
+            rate: float = count / hours if hours > 0 else float(count)
+            result.append(ChannelSpread(channel_id, count, rate))
+        return result
+
+    def reproduction(self, limit: int = 6) -> List[Reproduction]:
+        """Get the effective reproduction number of the last periods.
+
+        Members infected in the last periods may still infect others,
+        so the most recent values are underestimated.
+        """
+        result: List[Reproduction] = []
+        for period in sorted(self.cohorts)[-limit:]:
+            infected, secondary = self.cohorts[period]
+            if not infected:
+                continue
+            start = datetime.datetime.fromtimestamp(
+                period * self.period, tz=datetime.timezone.utc
+            )
+            result.append(Reproduction(start, infected, secondary / infected))
+        return result
+
+
+class TransmissionStats:
+    """Transmission trees of all guilds.
+
+    :param period: Length of the periods of the reproduction number.
+    """
+
+    def __init__(self, period: datetime.timedelta = datetime.timedelta(hours=1)):
+        self.period: datetime.timedelta = period
+        self.guilds: Dict[int, GuildStats] = {}
+
+    def rebuild(
+        self,
+        rows: Iterable[Tuple[int, int, int, int, datetime.datetime]],
+        *,
+        guild_id: Optional[int] = None,
+    ) -> None:
+        """Rebuild the trees from database rows.
+
+        :param rows: Iterable of
+            ``(guild_id, user_id, infected_by, channel_id, infected_at)``,
+            ordered by the time of infection.
+        :param guild_id: If set, only this guild is replaced.
+        """
+        if guild_id is None:
+            self.guilds.clear()
+        else:
+            self.guilds.pop(guild_id, None)
+        for row in rows:
+            self.add(*row)
+
+    def add(
+        self,
+        guild_id: int,
+        user_id: int,
+        infected_by: int,
+        channel_id: int,
+        infected_at: datetime.datetime,
+    ) -> None:
+        stats: Optional[GuildStats] = self.guilds.get(guild_id, None)
+        if stats is None:
+            stats = self.guilds[guild_id] = GuildStats(self.period)
+        stats.add(user_id, infected_by, channel_id, infected_at)
+
+    def get(self, guild_id: int) -> Optional[GuildStats]:
+        return self.guilds.get(guild_id, None)
@@ -0,0 +1,80 @@
+import random
+from typing import Callable, Dict, Union
+
+import nextcord
+
+import pie._tracing
+
+
+class _LazyMessage:
+    """Trace message that is only formatted when converted to string."""
+
+    __slots__ = ("message", "args")
+
+    def __init__(self, message: Union[str, Callable[[], str]], args: tuple):
+        self.message = message
+        self.args = args
+
+    def __str__(self) -> str:
+        if callable(self.message):
+            return self.message()
+        if self.args:
+            return self.message.format(*self.args)
+        return self.message
+
+
+class Tracer:
+    """Tracing function with deferred formatting.
+
+    Instead of an f-string, the message is passed as a format string with
+    arguments, or as a callable returning the message::
+
+        _trace("Infecting {}: rolled {}.", message.author, roll)
+        _trace(lambda: f"Guild {guild.name} has {len(members)} members.")
+
+    Formatting (and the ``str()`` calls on the arguments) only happens when
+    the tracing is turned on for the module and the message gets printed.
+    When :attr:`enabled` is off, the calls return right away.
+
+    Messages that belong to a guild can be sampled, so large guilds
+    do not flood the output.
+
+    :param name: Name of the traced module.
+    :param large_guild: Member count from which a guild is sampled.
+    :param sample_rate: Fraction of messages traced in large guilds.
+    """
+
+    def __init__(
+        self, name: str, *, large_guild: int = 1000, sample_rate: float = 0.01
+    ):
+        self._trace: Callable = pie._tracing.register(name)
+        # pie decides whether the messages are printed, this only skips
+        # them before any work is done; it can be switched at runtime
+        self.enabled: bool = True
+        self.large_guild: int = large_guild
+        self.sample_rate: float = sample_rate
+        # Guild ID -> sample rate, overrides the size based rate
+        self.sample_rates: Dict[int, float] = {}
+
+    def __call__(self, message: Union[str, Callable[[], str]], *args) -> None:
+        if not self.enabled:
+            return
+        self._trace(_LazyMessage(message, args))
+
+    def guild(
+        self,
+        guild: nextcord.Guild,
+        message: Union[str, Callable[[], str]],
+        *args,
+    ) -> None:
+        """Trace message, sampling it in high-volume guilds."""
+        if not self.enabled:
+            return
+        rate: float = self.sample_rates.get(guild.id, 1.0)
+        if guild.id not in self.sample_rates and (guild.member_count or 0) >= (
+            self.large_guild
+        ):
+            rate = self.sample_rate
+        if rate < 1.0 and random.random() >= rate:
+            return
+        self._trace(_LazyMessage(message, args))
@@ -0,0 +1,139 @@
+from typing import List, Optional
+
+import nextcord
+from nextcord.ext import commands
+
+from pie import i18n, utils
+
+from .database import AsyncInfected, Infected
+
+_ = i18n.Translator("modules/events").translate
+
+
+class InfectionListView(nextcord.ui.View):
+    """Paginated list of infected members.
+
+    Only one page is loaded from the database at a time, using the message
+    ID of the first or last row on the current page as the key of the
+    previous or next one. User names are only resolved for the shown rows.
+
+    :param ctx: Command context; only its author can turn the pages.
+    :param status: Show only members with this status.
+    :param infected_by: Show only members infected by this user.
+    :param page_size: Number of rows on a page.
+    """
+
+    def __init__(
+        self,
+        ctx: commands.Context,
+        *,
+        status: Optional[str] = None,
+        infected_by: Optional[int] = None,
+        page_size: int = 15,
+        timeout: float = 300.0,
+    ):
+        super().__init__(timeout=timeout)
+        self.ctx = ctx
+        self.status: Optional[str] = status
+        self.infected_by: Optional[int] = infected_by
+        self.page_size: int = page_size
+
+        self.rows: List[Infected] = []
+        self.message: Optional[nextcord.Message] = None
+
+    async def load(
+        self, *, after: Optional[int] = None, before: Optional[int] = None
+    ) -> bool:
+        """Load the page after or before given message ID.
+
+        :return: Whether there were any rows.
+        """
+        # One row more tells if there is another page in that direction
+        rows: List[Infected] = await AsyncInfected.get_page(
+            self.ctx.guild.id,
+            limit=self.page_size + 1,
+            after=after,
+            before=before,
+            status=self.status,
+            infected_by=self.infected_by,
+        )
+        if not rows:
+            return False
+
+        more: bool = len(rows) > self.page_size
+        if before is not None:
+            self.rows = rows[-self.page_size :]
+            self.previous.disabled = not more
+            self.next.disabled = False
+        else:
+            self.rows = rows[: self.page_size]
+            self.previous.disabled = after is None
+            self.next.disabled = not more
+        return True
+
+    def render(self) -> str:
+        ctx = self.ctx
+        # The translations are the same for every row
+        patient_zero: str = _(ctx, "(patient zero)")
+        statuses = {
+            "asymptomatic": _(ctx, "Asymptomatic"),
+            "symptomatic": _(ctx, "Symptomatic"),
+            "cured": _(ctx, "Cured"),
+        }
+
+        class Item:
+            def __init__(self, bot: commands.Bot, user: Infected):
+                dc_user = bot.get_user(user.user_id)
+                self.name = getattr(dc_user, "name", user.user_id)
+                self.infected_at = utils.time.format_datetime(user.infected_at)
+                if user.infected_by == 0:
+                    self.infected_by = patient_zero
+                else:
+                    infected_by = bot.get_user(user.infected_by)
+                    self.infected_by = getattr(infected_by, "name", user.infected_by)
+                if user.cured:
+                    self.status = statuses["cured"]
+                elif user.symptomatic:
+                    self.status = statuses["symptomatic"]
+                else:
+                    self.status = statuses["asymptomatic"]
+
+        table: List[str] = utils.text.create_table(
+            [Item(ctx.bot, user) for user in self.rows],
+            header={
+                "name": _(ctx, "Name"),
+                "infected_at": _(ctx, "Infected at"),
+                "infected_by": _(ctx, "Infected by"),
+                "status": _(ctx, "Status"),
+            },
+        )
+        return "```" + "".join(table) + "```"
+
+    async def interaction_check(self, interaction: nextcord.Interaction) -> bool:
+        return interaction.user.id == self.ctx.author.id
+
+    async def on_timeout(self):
+        for child in self.children:
+            child.disabled = True
+        if self.message is not None:
+            try:
+                await self.message.edit(view=self)
+            except nextcord.HTTPException:
+                pass
+
+    @nextcord.ui.button(label="◀", style=nextcord.ButtonStyle.secondary)
+    async def previous(
+        self, button: nextcord.ui.Button, interaction: nextcord.Interaction
+    ):
+        await self._turn(interaction, before=self.rows[0].message_id)
+
+    @nextcord.ui.button(label="▶", style=nextcord.ButtonStyle.secondary)
+    async def next(self, button: nextcord.ui.Button, interaction: nextcord.Interaction):
+        await self._turn(interaction, after=self.rows[-1].message_id)
+
+    async def _turn(self, interaction: nextcord.Interaction, **kwargs):
+        if not await self.load(**kwargs):
+            # The rows were deleted in the meantime
+            button = self.previous if "before" in kwargs else self.next
+            button.disabled = True
+        await interaction.response.edit_message(content=self.render(), view=self)